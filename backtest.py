@@ -0,0 +1,126 @@
+"""Офлайн-бэктест балльной системы analyze_and_predict на сохраненных свечах.
+
+Свечи берутся из папки с файлами Parquet/CSV (по одному на пару): имя файла — тикер Yfinance
+(EURUSD=X.parquet) или пара через подчеркивание (EUR_USD.csv). Сеть не нужна. Бары файла
+ресемплингом собираются в --timeframe (он не может быть мельче баров файла).
+
+Запуск:
+    python backtest.py --data ./data --timeframe 1h --output backtest.json
+"""
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import main
+
+WARMUP_BARS = 50  # analyze_and_predict не дает сигнал, пока в окне меньше 50 баров
+
+def find_data_file(data_dir: str, symbol: str):
+    """Ищет файл свечей пары по тикеру или по имени пары."""
+    names = (main.PAIRS_TICKERS[symbol], symbol.replace('/', '_'))
+    return next(filter(None, (main.find_ohlcv_file(data_dir, name) for name in names)), None)
+
+def bar_timeframe(df: pd.DataFrame):
+    """Таймфрейм баров файла по самому частому шагу времени (None, если шаг нестандартный)."""
+    step = pd.Series(df.index).diff().mode()
+    seconds = int(step[0].total_seconds()) if len(step) else None
+    return next((tf for tf, bar in main.TIMEFRAME_SECONDS.items() if bar == seconds), None)
+
+def load_bars(path: str, timeframe: str) -> pd.DataFrame:
+    """Свечи файла в таймфрейме бэктеста: бары мельче собираются ресемплингом, крупнее — ошибка."""
+    df = main.read_ohlcv_file(path)
+    source = bar_timeframe(df)
+    if source is None or main.TIMEFRAME_SECONDS[timeframe] % main.TIMEFRAME_SECONDS[source]:
+        raise ValueError(f"{path}: бары {source or 'с нестандартным шагом'} не собираются в {timeframe}")
+    return main.resample_ohlcv(df, timeframe, base=source)
+
+def backtest_pair(symbol: str, path: str, timeframe: str, horizon: int) -> dict:
+    """Прогоняет все бары пары через правила SCORE_RULES и проверяет направление через horizon баров."""
+    started = time.perf_counter()
+    df = load_bars(path, timeframe)
+    main.compute_indicators(df)
+
+    score = main.score_frame(df).to_numpy()
+    close = df['close'].to_numpy()
+    move = np.full(len(close), np.nan)
+    move[:-horizon] = close[horizon:] - close[:-horizon]
+
+    direction = np.sign(score)
+    valid = (direction != 0) & ~np.isnan(move)
+    valid[:WARMUP_BARS - 1] = False
+    hits = valid & (np.sign(move) == direction)
+
+    by_score = {}
+    for value in np.unique(score[valid]):
+        mask = valid & (score == value)
+        by_score[int(value)] = {'signals': int(mask.sum()), 'hits': int(hits[mask].sum())}
+
+    signals = int(valid.sum())
+    return {
+        'symbol': symbol,
+        'bars': len(df),
+        'signals': signals,
+        'hits': int(hits.sum()),
+        'hit_rate': round(hits.sum() / signals, 4) if signals else None,
+        'by_score': by_score,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+def run_backtest(data_dir: str, timeframe: str, workers: int = None) -> dict:
+    """Бэктест по всем парам PAIRS_TICKERS, по одному процессу на пару."""
+    horizon = main.EXPIRATION_BARS
+
+    jobs = {}
+    for symbol in main.PAIRS:
+        path = find_data_file(data_dir, symbol)
+        if path is None:
+            print(f"⚠️ Нет файла свечей для {symbol}, пропускаю")
+            continue
+        jobs[symbol] = path
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers or min(len(jobs), os.cpu_count() or 1) or 1) as pool:
+        futures = {symbol: pool.submit(backtest_pair, symbol, path, timeframe, horizon) for symbol, path in jobs.items()}
+        pairs = [future.result() for future in futures.values()]
+
+    signals = sum(p['signals'] for p in pairs)
+    hits = sum(p['hits'] for p in pairs)
+    return {
+        'timeframe': timeframe,
+        'horizon_bars': horizon,
+        'pairs': pairs,
+        'total': {
+            'bars': sum(p['bars'] for p in pairs),
+            'signals': signals,
+            'hits': hits,
+            'hit_rate': round(hits / signals, 4) if signals else None,
+        },
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+def print_report(report: dict):
+    print(f"Таймфрейм {report['timeframe']}, проверка через {report['horizon_bars']} бар(а)")
+    print(f"{'Пара':<10}{'Бары':>8}{'Сигналы':>10}{'Попадания':>11}{'Hit rate':>10}")
+    for p in report['pairs'] + [dict(report['total'], symbol='ИТОГО')]:
+        hit_rate = f"{p['hit_rate']:.2%}" if p['hit_rate'] is not None else '—'
+        print(f"{p['symbol']:<10}{p['bars']:>8}{p['signals']:>10}{p['hits']:>11}{hit_rate:>10}")
+    print(f"Готово за {report['seconds']} сек")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Офлайн-бэктест сигналов по сохраненным свечам")
+    parser.add_argument('--data', required=True, help="Папка с файлами свечей (Parquet/CSV)")
+    parser.add_argument('--timeframe', default=main.TIMEFRAME, choices=sorted(main.TIMEFRAME_SECONDS))
+    parser.add_argument('--workers', type=int, default=None, help="Число процессов (по умолчанию — по паре на ядро)")
+    parser.add_argument('--output', help="Сохранить отчет в JSON")
+    args = parser.parse_args()
+
+    report = run_backtest(args.data, args.timeframe, args.workers)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,179 @@
+"""Бенчмарк конвейера анализа на записанных свечах: загрузка -> индикаторы pandas_ta -> балл -> сообщение.
+
+Сначала один раз записываем фикстуры (нужна сеть):
+    python benchmark.py record --fixtures ./fixtures
+Затем замеры полностью офлайн, результат — JSON для сравнения прогонов:
+    python benchmark.py run --fixtures ./fixtures --output bench.json [--compare prev.json]
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import tracemalloc
+
+import main
+
+# Длины истории 1h-баров: 7 дней (как в боте), 60 дней и 2 года (максимум Yfinance для 1h)
+HISTORY_LENGTHS = {'7d': '7d', '60d': '60d', '2y': '730d'}
+
+def fixture_path(fixtures_dir: str, length: str, symbol: str) -> str:
+    return os.path.join(fixtures_dir, length, main.PAIRS_TICKERS[symbol] + '.csv')
+
+def record(fixtures_dir: str, timeframe: str):
+    """Скачивает свечи всех пар для каждой длины истории и сохраняет в CSV.
+
+    Напрямую через цепочку поставщиков, мимо bar_store: каждая длина — полная загрузка за свой период,
+    и фикстуры не попадают в хранилище бота.
+    """
+    tickers = [main.PAIRS_TICKERS[symbol] for symbol in main.PAIRS]
+    for length, period in HISTORY_LENGTHS.items():
+        os.makedirs(os.path.join(fixtures_dir, length), exist_ok=True)
+        days = min(main.period_days(period), main.YF_MAX_DAYS[timeframe])
+        frames = main.provider_chain.fetch(tickers, timeframe, None, days)
+        for symbol in main.PAIRS:
+            df = frames.get(main.PAIRS_TICKERS[symbol])
+            if df is not None:
+                df.to_csv(fixture_path(fixtures_dir, length, symbol))
+        print(f"{length}: записано {len(frames)}/{len(main.PAIRS)} пар")
+
+def measure(func, repeats: int) -> dict:
+    """Время (медиана/минимум по repeats прогонам) и память одного отдельного прогона под tracemalloc.
+
+    func() готовит входные данные и возвращает функцию для замера, чтобы подготовка не попадала в замер.
+    """
+    timings = []
+    for _ in range(repeats):
+        target = func()
+        started = time.perf_counter()
+        target()
+        timings.append(time.perf_counter() - started)
+
+    target = func()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    target()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'seconds_median': statistics.median(timings),
+        'seconds_min': min(timings),
+        'alloc_bytes': after - before,
+        'peak_bytes': peak - before,
+    }
+
+def bench_pair(path: str, symbol: str, repeats: int) -> dict:
+    """Замер каждого этапа конвейера для одной пары."""
+    stages = {}
+    stages['load'] = measure(lambda: lambda: main.read_ohlcv_file(path), repeats)
+    bars = main.read_ohlcv_file(path)
+
+    # Каждый индикатор цепочки меряем на кадре, где уже посчитаны предыдущие (как в compute_indicators)
+    prepared = bars.copy()
+    for name, step in main.INDICATOR_CHAIN:
+        stages[f'indicators.{name}'] = measure(lambda: (lambda df=prepared.copy(): step(df)), repeats)
+        step(prepared)
+
+    stages['score'] = measure(lambda: lambda: main.score_signal(prepared.iloc[-1], symbol), repeats)
+    signal = main.score_signal(prepared.iloc[-1], symbol)
+    stages['format'] = measure(lambda: lambda: main.render_signal_message(signal), repeats)
+
+    # Инкрементальный движок: полный прогрев и обновление одним новым баром
+    def engine_warm():
+        engine = main.IndicatorEngine()
+        return lambda: engine.update(symbol, bars)
+
+    def engine_next_bar():
+        engine = main.IndicatorEngine()
+        engine.update(symbol, bars.iloc[:-1])
+        return lambda: engine.update(symbol, bars)
+
+    stages['incremental.warm'] = measure(engine_warm, repeats)
+    stages['incremental.next_bar'] = measure(engine_next_bar, repeats)
+
+    return {'symbol': symbol, 'bars': len(bars), 'stages': stages}
+
+def summarize(results: list) -> dict:
+    """Медиана по парам для каждой длины истории и этапа."""
+    summary = {}
+    for length in {r['length'] for r in results}:
+        rows = [r for r in results if r['length'] == length]
+        summary[length] = {
+            stage: {
+                key: statistics.median(r['stages'][stage][key] for r in rows)
+                for key in ('seconds_median', 'alloc_bytes', 'peak_bytes')
+            }
+            for stage in rows[0]['stages']
+        }
+    return summary
+
+def run(fixtures_dir: str, repeats: int) -> dict:
+    # main грузит pandas лениво; импорт не должен попасть в замер первой пары
+    main.preimport_analytics()
+    results = []
+    for length in HISTORY_LENGTHS:
+        for symbol in main.PAIRS:
+            path = fixture_path(fixtures_dir, length, symbol)
+            if not os.path.exists(path):
+                print(f"⚠️ Нет фикстуры {path}, пропускаю")
+                continue
+            results.append(dict(bench_pair(path, symbol, repeats), length=length))
+        print(f"{length}: готово")
+
+    import pandas
+    import pandas_ta
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pandas': pandas.__version__,
+            'pandas_ta': getattr(pandas_ta, 'version', None) or getattr(pandas_ta, '__version__', None),
+            'repeats': repeats,
+        },
+        'summary': summarize(results),
+        'results': results,
+    }
+
+def print_summary(report: dict, baseline: dict = None):
+    for length, stages in report['summary'].items():
+        print(f"\n== {length} ==")
+        print(f"{'Этап':<26}{'мс (медиана)':>14}{'alloc КБ':>12}{'peak КБ':>12}" + (f"{'к базе':>10}" if baseline else ''))
+        for stage, row in stages.items():
+            line = f"{stage:<26}{row['seconds_median'] * 1000:>14.3f}{row['alloc_bytes'] / 1024:>12.1f}{row['peak_bytes'] / 1024:>12.1f}"
+            base = (baseline or {}).get('summary', {}).get(length, {}).get(stage)
+            if base and base['seconds_median']:
+                line += f"{row['seconds_median'] / base['seconds_median']:>9.2f}x"
+            print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера анализа на записанных свечах")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    rec = sub.add_parser('record', help="Записать фикстуры из Yfinance (нужна сеть)")
+    rec.add_argument('--fixtures', default='fixtures')
+    rec.add_argument('--timeframe', default=main.TIMEFRAME)
+
+    bench = sub.add_parser('run', help="Прогнать бенчмарк офлайн")
+    bench.add_argument('--fixtures', default='fixtures')
+    bench.add_argument('--repeats', type=int, default=5)
+    bench.add_argument('--output', default='bench.json')
+    bench.add_argument('--compare', help="JSON прошлого прогона для сравнения")
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.fixtures, args.timeframe)
+        sys.exit(0)
+
+    report = run(args.fixtures, args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_summary(report, baseline)
+    print(f"\nРезультаты: {args.output}")
@@ -0,0 +1,367 @@
+"""Нагрузочный тест вебхука: синтетические апдейты Telegram против настоящего aiohttp-приложения.
+
+Бот запускается отдельным процессом (python main.py): Bot API направлен на локальную заглушку
+(TELEGRAM_API_URL), свечи отдает поставщик replay (синтетические или записанные файлы),
+выходные отключены — сеть не нужна. Нагрузка — замкнутый цикл: N виртуальных пользователей,
+каждый шлет следующее действие (/start, pairs, analyze_*, result_*, history) после ответа бота
+на предыдущее. Для каждого уровня N из --levels — пропускная способность, перцентили задержки и доля ошибок.
+
+Запуск:
+    python loadtest.py --levels 1,10,50,100 --duration 30 --output loadtest.json
+    python loadtest.py --data ./fixtures/60d --sync-webhook --workers 2 --state-url redis://localhost:6379/0
+
+Несколько воркеров (--workers > 1) делят состояние только через Redis: нужен --state-url.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import asyncio
+import tempfile
+import subprocess
+from collections import Counter
+
+from aiohttp import web, ClientSession, ClientTimeout, ClientError, MultipartReader
+
+import main
+
+TOKEN = '123456:LOADTEST'
+REPLY_TIMEOUT = 30  # Сек на ответ бота, дольше — ошибка timeout
+
+# Доли действий в смеси (веса random.choices)
+ACTION_MIX = {'start': 1, 'pairs': 2, 'analyze': 5, 'strength': 1, 'result': 1, 'history': 1}
+
+STUB_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+
+# --- ЗАГЛУШКА BOT API ---
+
+class TelegramStub:
+    """Отвечает на вызовы Bot API правдоподобными объектами и будит пользователя, которому пришел ответ."""
+
+    def __init__(self, latency: float, flood_rate: float):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.calls = Counter()   # метод -> число вызовов
+        self.waiters = {}        # chat_id -> Future ответа на текущее действие
+        self.webhook_replies = Counter()  # метод -> сколько раз бот ответил им прямо в теле ответа вебхука
+        self.signals = {}        # chat_id -> signal_id из кнопок результата последнего сигнала
+        self._message_id = 0
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        data = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ('sendMessage', 'editMessageText') and random.random() < self.flood_rate:
+            self.calls['429'] += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429, 'description': "Too Many Requests: retry after 1",
+                'parameters': {'retry_after': 1},
+            })
+
+        if method == 'answerCallbackQuery':
+            chat_id = int(data['callback_query_id'].split('-')[0])
+        else:
+            chat_id = int(data.get('chat_id', 0))
+        if 'reply_markup' in data:
+            for row in json.loads(data['reply_markup']).get('inline_keyboard', []):
+                for button in row:
+                    if button.get('callback_data', '').startswith('result_win_'):
+                        self.signals[chat_id] = button['callback_data'][len('result_win_'):]
+
+        # Ответ на действие — сообщение или всплывающее уведомление (ошибки фиксации результата)
+        if method in ('sendMessage', 'editMessageText') or (method == 'answerCallbackQuery' and data.get('show_alert') == 'true'):
+            waiter = self.waiters.get(chat_id)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+        return web.json_response({'ok': True, 'result': self._result(method, data, chat_id)})
+
+    def _result(self, method: str, data: dict, chat_id: int):
+        if method == 'getMe':
+            return STUB_USER
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            self._message_id += 1
+            return {
+                'message_id': int(data.get('message_id', self._message_id)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': STUB_USER,
+                'text': data.get('text', ''),
+            }
+        return True
+
+async def start_stub(stub: TelegramStub, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', stub.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+# --- ДАННЫЕ И ПРОЦЕСС БОТА ---
+
+def write_synthetic_data(directory: str, timeframe: str, days: int):
+    """Случайное блуждание по всем тикерам в CSV (формат выгрузки Yfinance) для поставщика replay."""
+    os.makedirs(directory, exist_ok=True)
+    bar = main.TIMEFRAME_SECONDS[timeframe]
+    count = days * 86400 // bar
+    end = int(time.time()) // bar * bar
+    for ticker in main.PAIRS_TICKERS.values():
+        price = random.uniform(0.6, 180)
+        lines = ["Datetime,Open,High,Low,Close,Volume"]
+        for i in range(count):
+            ts = time.strftime('%Y-%m-%d %H:%M:%S+00:00', time.gmtime(end - (count - 1 - i) * bar))
+            close = price * (1 + random.gauss(0, 0.0008))
+            high = max(price, close) * (1 + abs(random.gauss(0, 0.0003)))
+            low = min(price, close) * (1 - abs(random.gauss(0, 0.0003)))
+            lines.append(f"{ts},{price:.5f},{high:.5f},{low:.5f},{close:.5f},{random.randint(100, 5000)}")
+            price = close
+        with open(os.path.join(directory, ticker + '.csv'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+def start_app(args, port: int, api_url: str, data_dir: str, workdir: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        TELEGRAM_TOKEN=TOKEN,
+        WEBHOOK_URL=f'http://127.0.0.1:{port}',
+        PORT=str(port),
+        TELEGRAM_API_URL=api_url,
+        DATA_PROVIDERS='replay',
+        REPLAY_DATA_DIR=data_dir,
+        BAR_STORE_DIR='',
+        HISTORY_DB_PATH=os.path.join(workdir, 'history.db'),
+        WEEKEND_BLOCK='0',
+        WEBHOOK_BACKGROUND='0' if args.sync_webhook else '1',
+        WEB_CONCURRENCY=str(args.workers),
+        SEND_GLOBAL_RATE=str(args.send_rate),
+        PREWARM_ENABLED='0' if args.no_prewarm else '1',
+    )
+    if args.workers > 1:  # Иначе run_workers откажется стартовать
+        env.update(STATE_BACKEND='redis', STATE_BACKEND_URL=args.state_url, HISTORY_BACKEND='shared')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    return subprocess.Popen([sys.executable, script], env=env)
+
+async def wait_ready(session: ClientSession, base_url: str, app: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if app.poll() is not None:
+            raise RuntimeError(f"Бот завершился с кодом {app.returncode}")
+        try:
+            async with session.get(base_url + '/metrics') as resp:
+                if resp.status == 200:
+                    return
+        except ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"Бот не поднялся за {timeout:.0f} сек")
+
+# --- НАГРУЗКА ---
+
+class VirtualUser:
+    """Пользователь, который шлет действия из ACTION_MIX одно за другим."""
+
+    def __init__(self, uid: int):
+        self.uid = uid
+        self.seq = 0
+        self.user = {'id': uid, 'is_bot': False, 'first_name': f'Load{uid}'}
+        self.chat = {'id': uid, 'type': 'private'}
+
+    def update(self, action: str, signal_id: str = None) -> dict:
+        self.seq += 1
+        update_id = self.uid * 1_000_000 + self.seq
+        if action == 'start':
+            return {'update_id': update_id, 'message': {
+                'message_id': self.seq, 'date': int(time.time()), 'chat': self.chat, 'from': self.user, 'text': '/start',
+            }}
+        if action == 'analyze':
+            pair = random.choice(main.PAIRS).replace('/', '_')
+            timeframe = random.choice(main.ANALYSIS_TIMEFRAMES)
+            data = f'analyze_{pair}' if timeframe == main.TIMEFRAME else f'analyze_{pair}:{timeframe}'
+        elif action == 'result':
+            data = f"result_{random.choice(('win', 'loss'))}_{signal_id or 'missing'}"
+        else:
+            data = action
+        return {'update_id': update_id, 'callback_query': {
+            'id': f'{self.uid}-{self.seq}', 'from': self.user, 'chat_instance': str(self.uid), 'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': self.chat, 'from': STUB_USER, 'text': 'menu'},
+        }}
+
+async def read_webhook_reply(resp) -> dict:
+    """Метод Bot API из тела ответа вебхука (--sync-webhook), поля формы как строки; {} — если его нет."""
+    if not resp.content_type.startswith('multipart/'):
+        await resp.read()
+        return {}
+    fields = {}
+    async for part in MultipartReader.from_response(resp):
+        fields[part.name] = await part.text()
+    return fields
+
+async def run_user(user: VirtualUser, session: ClientSession, url: str, stub: TelegramStub, stop_at: float,
+                   samples: list, think: float):
+    loop = asyncio.get_running_loop()
+    actions, weights = list(ACTION_MIX), list(ACTION_MIX.values())
+    headers = {'X-Telegram-Bot-Api-Secret-Token': TOKEN}
+    while time.monotonic() < stop_at:
+        action = random.choices(actions, weights)[0]
+        # Фиксация результата без сигнала у пользователя — проверка пути «сигнал не найден»
+        payload = user.update(action, stub.signals.pop(user.uid, None) if action == 'result' else None)
+        waiter = stub.waiters[user.uid] = loop.create_future()
+        started = time.perf_counter()
+        sample = {'action': action, 'error': None, 'webhook': None, 'reply': None}
+        try:
+            async with session.post(url, json=payload, headers=headers) as resp:
+                method = await read_webhook_reply(resp)
+                sample['webhook'] = time.perf_counter() - started
+                if resp.status != 200:
+                    sample['error'] = f'http_{resp.status}'
+            if method:
+                stub.webhook_replies[method.get('method')] += 1
+                # Всплывающее уведомление в ответе вебхука — это и есть ответ на действие
+                if method.get('show_alert') == 'true' and not waiter.done():
+                    waiter.set_result(time.perf_counter())
+            if sample['error'] is None:
+                sample['reply'] = await asyncio.wait_for(waiter, REPLY_TIMEOUT) - started
+        except asyncio.TimeoutError:
+            sample['error'] = 'timeout'
+        except ClientError as e:
+            sample['error'] = type(e).__name__
+        finally:
+            stub.waiters.pop(user.uid, None)
+        samples.append(sample)
+        if think:
+            await asyncio.sleep(random.expovariate(1 / think))
+
+async def run_level(users: int, duration: float, session: ClientSession, url: str, stub: TelegramStub, think: float) -> dict:
+    samples = []
+    calls_before = Counter(stub.calls)
+    replies_before = Counter(stub.webhook_replies)
+    started = time.monotonic()
+    await asyncio.gather(*(
+        run_user(VirtualUser(10_000 + i), session, url, stub, started + duration, samples, think) for i in range(users)
+    ))
+    elapsed = time.monotonic() - started
+    calls = stub.calls - calls_before
+    webhook_replies = stub.webhook_replies - replies_before
+
+    ok = [s for s in samples if s['error'] is None]
+    reply = [s['reply'] for s in ok]
+    errors = Counter(s['error'] for s in samples if s['error'])
+    by_action = {}
+    for action in ACTION_MIX:
+        latencies = [s['reply'] for s in ok if s['action'] == action]
+        by_action[action] = {'count': len(latencies), 'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99)}
+    return {
+        'users': users,
+        'seconds': round(elapsed, 2),
+        'actions': len(samples),
+        'throughput': round(len(ok) / elapsed, 2),
+        'reply_p50': percentile(reply, 0.5),
+        'reply_p90': percentile(reply, 0.9),
+        'reply_p99': percentile(reply, 0.99),
+        'webhook_p50': percentile([s['webhook'] for s in ok], 0.5),
+        'webhook_p99': percentile([s['webhook'] for s in ok], 0.99),
+        'error_rate': round(sum(errors.values()) / len(samples), 4) if samples else None,
+        'errors': dict(errors),
+        'api_calls': dict(calls),
+        'api_calls_per_action': round(sum(v for k, v in calls.items() if k != '429') / len(ok), 2) if ok else None,
+        'webhook_replies': dict(webhook_replies),  # Ответы телом ответа вебхука — не вызовы Bot API
+        'by_action': by_action,
+    }
+
+def print_report(report: dict):
+    def ms(value):
+        return f"{value * 1000:.0f}" if value is not None else '—'
+    print(f"\n{'Польз.':>7}{'Действ/с':>10}{'p50 мс':>9}{'p90 мс':>9}{'p99 мс':>9}{'webhook p99':>13}{'Ошибки':>9}{'API/действ':>12}")
+    for r in report['levels']:
+        error_rate = f"{r['error_rate']:.1%}" if r['error_rate'] is not None else '—'
+        per_action = r['api_calls_per_action'] if r['api_calls_per_action'] is not None else '—'
+        print(f"{r['users']:>7}{r['throughput']:>10}{ms(r['reply_p50']):>9}{ms(r['reply_p90']):>9}{ms(r['reply_p99']):>9}"
+              f"{ms(r['webhook_p99']):>13}{error_rate:>9}{per_action:>12}")
+        if r['errors']:
+            print(f"{'':>7}ошибки: {r['errors']}")
+        if r['webhook_replies']:
+            print(f"{'':>7}ответы телом вебхука: {r['webhook_replies']}")
+
+async def run(args) -> dict:
+    stub = TelegramStub(args.api_latency, args.flood_rate)
+    stub_port, app_port = free_port(), free_port()
+    stub_runner = await start_stub(stub, stub_port)
+
+    with tempfile.TemporaryDirectory(prefix='loadtest-') as workdir:
+        data_dir = args.data
+        if data_dir is None:
+            data_dir = os.path.join(workdir, 'replay')
+            write_synthetic_data(os.path.join(data_dir, main.BASE_TIMEFRAME), main.BASE_TIMEFRAME, args.days)
+
+        app = start_app(args, app_port, f'http://127.0.0.1:{stub_port}', data_dir, workdir)
+        base_url = f'http://127.0.0.1:{app_port}'
+        levels = []
+        try:
+            async with ClientSession(timeout=ClientTimeout(total=REPLY_TIMEOUT)) as session:
+                await wait_ready(session, base_url, app)
+                if not args.no_prewarm:
+                    await asyncio.sleep(args.warmup)  # Прогрев снимков после старта
+                for users in args.levels:
+                    print(f"▶ {users} польз. x {args.duration:.0f} сек...")
+                    levels.append(await run_level(users, args.duration, session, base_url + '/' + TOKEN, stub, args.think))
+        finally:
+            app.terminate()
+            try:
+                app.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                app.kill()
+            await stub_runner.cleanup()
+
+    return {
+        'config': {
+            'duration': args.duration, 'think': args.think, 'workers': args.workers,
+            'sync_webhook': args.sync_webhook, 'send_rate': args.send_rate, 'api_latency': args.api_latency,
+            'flood_rate': args.flood_rate, 'data': args.data or f'synthetic {main.BASE_TIMEFRAME} x {args.days}d',
+            'mix': ACTION_MIX,
+        },
+        'levels': levels,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Нагрузочный тест вебхука бота на синтетическом трафике")
+    parser.add_argument('--levels', default='1,5,10,25,50,100', help="Число одновременных пользователей по уровням")
+    parser.add_argument('--duration', type=float, default=20, help="Сек на уровень")
+    parser.add_argument('--think', type=float, default=0, help="Средняя пауза пользователя между действиями, сек")
+    parser.add_argument('--data', help="Папка со свечами для replay (по умолчанию — синтетические)")
+    parser.add_argument('--days', type=int, default=30, help="Глубина синтетической истории, дней")
+    parser.add_argument('--workers', type=int, default=1, help="WEB_CONCURRENCY бота")
+    parser.add_argument('--state-url', help="Redis для общего состояния воркеров (обязателен при --workers > 1)")
+    parser.add_argument('--sync-webhook', action='store_true', help="handle_in_background=False (ответ вебхука после хендлера)")
+    parser.add_argument('--send-rate', type=float, default=1000,
+                        help="SEND_GLOBAL_RATE бота (лимит Telegram — 25; по умолчанию снят, чтобы мерить сам бот)")
+    parser.add_argument('--api-latency', type=float, default=0.02, help="Задержка ответа заглушки Bot API, сек")
+    parser.add_argument('--flood-rate', type=float, default=0, help="Доля ответов 429 на отправку сообщений")
+    parser.add_argument('--no-prewarm', action='store_true', help="Без фонового прогрева (холодный путь анализа)")
+    parser.add_argument('--warmup', type=float, default=5, help="Пауза после старта на прогрев, сек")
+    parser.add_argument('--output', help="Сохранить отчет в JSON")
+    args = parser.parse_args()
+    args.levels = [int(n) for n in args.levels.split(',')]
+    if args.workers > 1 and not args.state_url:
+        parser.error("--workers > 1 требует --state-url: воркеры делят состояние только через Redis")
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты: {args.output}")
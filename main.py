@@ -1,148 +1,2402 @@
+from __future__ import annotations  # Аннотации pd.DataFrame не должны импортировать pandas при старте
+
+import time
+STARTED_AT = time.perf_counter()  # Точка отсчета для разбивки времени холодного старта
+
 import os
-from datetime import datetime
-import pandas as pd
-import pandas_ta as ta
+import sys
+import json
+import multiprocessing
+import signal as os_signal
+import copy
+import math
+import sqlite3
+import functools
+import hmac
+import importlib
+import contextvars
+import threading
+import fcntl
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta
 import pytz 
-import yfinance as yf 
 import asyncio # Импортируем asyncio для run_app
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# --- ИСПРАВЛЕННЫЕ ИМПОРТЫ AIOGRAM V3 ---
+from aiogram import Bot, Dispatcher, types 
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application 
+from aiohttp import web
+from aiogram.utils.markdown import code, bold
+from aiogram.utils.text_decorations import markdown_decoration
+from aiogram.filters import Command
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.methods import AnswerCallbackQuery
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+escape_md = markdown_decoration.quote  # Экранирование для MarkdownV2 (aiogram.utils.text в v3 нет)
+
+# --- ХОЛОДНЫЙ СТАРТ ---
+# Аналитический стек (numpy/pandas/pandas_ta/yfinance) грузится секунды, а /start и вебхук
+# в нем не нуждаются. Поэтому модули подключаются лениво: при первом обращении или
+# фоновым импортом уже после того, как сервер занял порт.
+
+startup_timings = OrderedDict()  # этап -> секунды (этапы импорта аналитики — длительность самого импорта)
+_startup_mark = [STARTED_AT]
+
+def mark_startup(stage: str):
+    """Записывает длительность этапа старта (от предыдущей отметки)."""
+    now = time.perf_counter()
+    startup_timings[stage] = now - _startup_mark[0]
+    _startup_mark[0] = now
+
+class LazyModule:
+    """Прокси модуля: настоящий импорт происходит при первом обращении к атрибуту."""
+
+    def __init__(self, name: str, *companions: str):
+        self._name = name
+        self._companions = companions  # Модули, которые надо импортировать вместе с этим
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _lazy_import(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    for companion in self._companions:
+                        importlib.import_module(companion)
+                    startup_timings[f'import_{self._name}'] = time.perf_counter() - started
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_import(), attr)
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas', 'pandas_ta')  # pandas_ta регистрирует аксессор df.ta, без него pandas нам не нужен
+yf = LazyModule('yfinance')
+
+def preimport_analytics():
+    """Импортирует аналитический стек заранее (вызывается в фоне после bind)."""
+    for module in (np, pd, yf):
+        module._lazy_import()
+
+mark_startup('imports')
+
+# --- 1. КОНФИГУРАЦИЯ ---
+
+# Читаем переменные из окружения Render.
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+WEBHOOK_HOST = os.getenv('WEBHOOK_URL')  # URL твоего сервиса на Render (напр., https://mybot.onrender.com)
+WEBAPP_PORT = int(os.getenv('PORT', 10000)) # Порт, который слушает твой worker
+
+# Определяем путь и полный URL для вебхука
+WEBHOOK_PATH = f'/{TELEGRAM_TOKEN}'
+if WEBHOOK_HOST:
+    WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
+else:
+    WEBHOOK_URL = None
+
+if not TELEGRAM_TOKEN:
+    print("❌ ОШИБКА: TELEGRAM_TOKEN не найден в переменных окружения. Бот не запустится.")
+    # Вместо exit(1) в асинхронном окружении, лучше просто завершить инициализацию
+    # Но для отладки оставим print. Запуск Webhooks ниже все равно не сработает без токена.
+
+# Настройка временной зоны (Москва/UTC+3)
+TIMEZONE = 'Europe/Moscow' 
+TZ = pytz.timezone(TIMEZONE)
+
+# Валютные пары и их тикеры для Yfinance
+PAIRS_TICKERS = {
+    "EUR/USD": "EURUSD=X", "GBP/USD": "GBPUSD=X", "USD/JPY": "USDJPY=X", 
+    "AUD/USD": "AUDUSD=X", "USD/CAD": "CAD=X", "USD/CHF": "CHF=X",
+    "EUR/JPY": "EURJPY=X", "GBP/JPY": "GBPJPY=X", "AUD/JPY": "AUDJPY=X", 
+    "EUR/GBP": "EURGBP=X", "EUR/AUD": "EURAUD=X", "GBP/AUD": "GBPAUD=X",
+    "CAD/JPY": "CADJPY=X", "CHF/JPY": "CHFJPY=X", "EUR/CAD": "EURCAD=X", 
+    "GBP/CAD": "GBPCAD=X", "AUD/CAD": "AUDCAD=X", "AUD/CHF": "AUDCHF=X", 
+    "CAD/CHF": "CADCHF=X"
+}
+PAIRS = list(PAIRS_TICKERS.keys())
+
+TIMEFRAME = '1h'   # Таймфрейм анализа по умолчанию
+
+# Мультитаймфрейм: с Yfinance качаем только базовый (самый мелкий) таймфрейм,
+# старшие получаем локально ресемплингом. 15m у Yfinance доступен максимум за 60 дней.
+BASE_TIMEFRAME = os.getenv('BASE_TIMEFRAME', '15m')
+LIMIT_DAYS = os.getenv('LIMIT_DAYS', '60d')   # Глубина загрузки базового таймфрейма
+ANALYSIS_TIMEFRAMES = os.getenv('ANALYSIS_TIMEFRAMES', '15m,1h,4h').split(',')  # Выбор пользователя в меню
+
+# Локальное хранилище закрытых баров: с Yfinance докачиваются только недостающие бары.
+# Пустой BAR_STORE_DIR отключает хранилище (каждый раз полная загрузка за LIMIT_DAYS).
+BAR_STORE_DIR = os.getenv('BAR_STORE_DIR', 'bars')
+
+NEUTRAL_DIRECTION = "НЕЙТРАЛЬНО ⚪"
+EXPIRATION_BARS = 3  # Горизонт сигнала в барах выбранного таймфрейма (он же горизонт проверки в бэктесте)
+EXPIRATIONS = {
+    '1m': "3 минуты", '5m': "15 минут", '15m': "45 минут", '30m': "1,5 часа",
+    '1h': "3 часа", '4h': "12 часов", '1d': "3 дня",
+}
+
+# Пул для блокирующих задач (загрузка Yfinance и расчет pandas_ta), чтобы не морозить event loop
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', 4))        # Размер пула потоков
+ANALYSIS_CONCURRENCY = int(os.getenv('ANALYSIS_CONCURRENCY', 8)) # Сколько задач одновременно допускаем в пул
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', 20))           # Таймаут загрузки данных, сек
+ANALYSIS_TIMEOUT = float(os.getenv('ANALYSIS_TIMEOUT', 10))     # Таймаут расчета индикаторов, сек
+
+# Кэш свечей: запись живет до закрытия текущего бара (+ запас, пока Yfinance дорисует новый бар)
+OHLCV_CACHE_SIZE = int(os.getenv('OHLCV_CACHE_SIZE', 128))      # Максимум записей (LRU): пары x таймфреймы
+OHLCV_CACHE_GRACE = float(os.getenv('OHLCV_CACHE_GRACE', 60))   # Запас после закрытия бара, сек
+
+# Фоновый прогрев: все пары одним пакетным запросом на каждом закрытии бара
+PREWARM_ENABLED = os.getenv('PREWARM_ENABLED', '1') == '1'
+PREWARM_DELAY = float(os.getenv('PREWARM_DELAY', 20))   # Сек после закрытия бара (меньше OHLCV_CACHE_GRACE)
+
+# История сигналов и подписки: 'sqlite' (по умолчанию), 'memory' или 'shared' (общий бэкенд STATE_BACKEND)
+HISTORY_BACKEND = os.getenv('HISTORY_BACKEND', 'sqlite')
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', 'history.db')
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', 1))      # Пакетная запись раз в N сек
+HISTORY_COMPACT_INTERVAL = float(os.getenv('HISTORY_COMPACT_INTERVAL', 3600))
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', 90))
+HISTORY_MAX_PER_USER = int(os.getenv('HISTORY_MAX_PER_USER', 200))
+
+# Подписки: алерт уходит, когда |балл| пары на новом баре достигает порога
+SUBSCRIPTION_THRESHOLD = int(os.getenv('SUBSCRIPTION_THRESHOLD', 6))
+
+# Сила валют и корреляции пар: закрытия всех пар сводятся в одну матрицу и считаются раз на бар
+STRENGTH_WINDOW = int(os.getenv('STRENGTH_WINDOW', 24))          # Баров для изменения цены (сила валюты)
+CORRELATION_WINDOW = int(os.getenv('CORRELATION_WINDOW', 100))   # Баров доходностей для корреляций
+STRENGTH_WEIGHT = int(os.getenv('STRENGTH_WEIGHT', 0))           # Баллов к сигналу за перевес валют (0 — не учитывать)
+STRENGTH_THRESHOLD = float(os.getenv('STRENGTH_THRESHOLD', 1.0)) # Перевес базовой валюты над котируемой, в сигмах
+
+# Лимиты рассылки (Telegram: ~30 сообщений/сек на бота, ~1 сообщение/сек в один чат)
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 25))
+SEND_CHAT_INTERVAL = float(os.getenv('SEND_CHAT_INTERVAL', 1))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 3))
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', 100))  # Соединений в пуле aiohttp-сессии бота
+
+# Нагрузочное тестирование (loadtest.py): Bot API можно направить на локальную заглушку,
+# выходные отключить, а апдейты вебхука обрабатывать синхронно (ответ Telegram — после хендлера)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')          # Например, http://127.0.0.1:8081
+WEEKEND_BLOCK = os.getenv('WEEKEND_BLOCK', '1') == '1'
+# handle_in_background у SimpleRequestHandler. 1 (по умолчанию): вебхук отвечает сразу, на нажатие кнопки —
+# 2 вызова Bot API (answer_callback_query + сообщение). 0: ответ на нажатие уходит телом ответа вебхука (1 вызов),
+# но соединение Telegram занято до конца хендлера, а тосты «Анализирую...» не показываются (см. answer())
+WEBHOOK_BACKGROUND = os.getenv('WEBHOOK_BACKGROUND', '1') == '1'
+
+# Поставщики свечей в порядке приоритета: 'yfinance', 'replay' (записанные файлы из REPLAY_DATA_DIR)
+DATA_PROVIDERS = os.getenv('DATA_PROVIDERS', 'yfinance').split(',')
+REPLAY_DATA_DIR = os.getenv('REPLAY_DATA_DIR', 'fixtures/60d')
+PROVIDER_HEDGE_AFTER = float(os.getenv('PROVIDER_HEDGE_AFTER', 5))        # Через сколько сек дублировать запрос следующему поставщику
+PROVIDER_FAILURE_THRESHOLD = int(os.getenv('PROVIDER_FAILURE_THRESHOLD', 3))  # Ошибок подряд до размыкания предохранителя
+PROVIDER_RESET_TIMEOUT = float(os.getenv('PROVIDER_RESET_TIMEOUT', 60))   # Сек до пробного запроса к отключенному поставщику
+
+# Холодный старт: после bind импортировать аналитику в фоне, а не на первом запросе анализа
+ANALYTICS_PREIMPORT = os.getenv('ANALYTICS_PREIMPORT', '1') == '1'
+
+# Несколько воркеров: WEB_CONCURRENCY процессов на одном порту (SO_REUSEPORT) и общий бэкенд состояния
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 1))
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')    # 'memory' | 'redis'
+STATE_BACKEND_URL = os.getenv('STATE_BACKEND_URL', 'redis://localhost:6379/0')
+
+# /metrics и /debug/profile требуют ?token=METRICS_TOKEN. Без токена /metrics открыт, а /debug/profile выключен
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 60))
+
+# Длительность бара в секундах для поддерживаемых таймфреймов Yfinance
+TIMEFRAME_SECONDS = {
+    '1m': 60, '5m': 300, '15m': 900, '30m': 1800,
+    '1h': 3600, '4h': 14400, '1d': 86400,
+}
+
+# Максимальная глубина, которую Yfinance отдает для таймфрейма, дней
+YF_MAX_DAYS = {'1m': 7, '5m': 60, '15m': 60, '30m': 60, '1h': 730, '4h': 730, '1d': 36500}
+
+# Правила pandas.resample для получения старших таймфреймов из базового
+RESAMPLE_RULES = {
+    '1m': '1min', '5m': '5min', '15m': '15min', '30m': '30min',
+    '1h': '1h', '4h': '4h', '1d': '1D',
+}
+
+def _check_timeframes():
+    """Таймфреймы анализа собираются ресемплингом базового: базовый не может быть крупнее них."""
+    base = TIMEFRAME_SECONDS[BASE_TIMEFRAME]
+    for timeframe in dict.fromkeys(ANALYSIS_TIMEFRAMES + [TIMEFRAME]):
+        if timeframe not in EXPIRATIONS or timeframe not in RESAMPLE_RULES:
+            raise ValueError(f"Неподдерживаемый таймфрейм анализа: {timeframe}")
+        if TIMEFRAME_SECONDS[timeframe] % base:
+            raise ValueError(f"Таймфрейм {timeframe} не собирается из базового BASE_TIMEFRAME={BASE_TIMEFRAME}")
+
+_check_timeframes()
+
+# Инициализация бота и диспетчера
+# Без токена модуль все равно импортируется (бэктест и другие офлайн-режимы)
+# Одна aiohttp-сессия с пулом keep-alive соединений на все вызовы Bot API
+api_server = {'api': TelegramAPIServer.from_base(TELEGRAM_API_URL)} if TELEGRAM_API_URL else {}
+session = AiohttpSession(limit=TELEGRAM_POOL_SIZE, **api_server)
+bot = Bot(
+    token=TELEGRAM_TOKEN, session=session, default=DefaultBotProperties(parse_mode='MarkdownV2')
+) if TELEGRAM_TOKEN else None
+dp = Dispatcher() # Диспетчер aiogram v3
+
+# --- МЕТРИКИ ---
+# Простой реестр в формате Prometheus (без внешних зависимостей): гистограммы задержек
+# и гейджи, значения которых читаются в момент запроса /metrics.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Реестр метрик. observe() можно вызывать из любых потоков."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # name -> {labels: Histogram}
+        self._gauges = {}      # name -> (тип, функция -> число или {значение_метки: число}, имя метки)
+        self._help = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name: str, help_text: str, func, label: str = None, kind: str = 'gauge'):
+        """Регистрирует значение, которое вычисляется при каждом запросе /metrics."""
+        self._help[name] = help_text
+        self._gauges[name] = (kind, func, label)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines += [f"# HELP {name} {self._help.get(name, name)}", f"# TYPE {name} histogram"]
+                for key, hist in sorted(series.items()):
+                    labels = ','.join(f'{k}="{v}"' for k, v in key)
+                    prefix = labels + ',' if labels else ''
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {hist.count}')
+                    lines.append(f'{name}_sum{{{labels}}} {hist.sum:.6f}')
+                    lines.append(f'{name}_count{{{labels}}} {hist.count}')
+
+        for name, (kind, func, label) in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                print(f"Ошибка метрики {name}: {e}")
+                continue
+            lines += [f"# HELP {name} {self._help[name]}", f"# TYPE {name} {kind}"]
+            if isinstance(value, dict):
+                lines += [f'{name}{{{label}="{k}"}} {v}' for k, v in value.items()]
+            else:
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('handler_seconds', "Время обработки апдейта хендлером aiogram")
+metrics.describe('stage_seconds', "Время этапов анализа: fetch (Yfinance), indicators (индикаторы)")
+metrics.describe('telegram_api_seconds', "Время запросов к Telegram Bot API по методам")
+metrics.describe('event_loop_lag_seconds', "Задержка event loop относительно запланированного пробуждения")
+metrics.describe('provider_seconds', "Время запросов к поставщикам свечей по исходу")
+
+def timed(name: str, **labels):
+    """Декоратор: пишет время выполнения синхронной функции в гистограмму."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+async def handler_timing_middleware(handler, event, data):
+    """Middleware aiogram: гистограмма задержек по каждому хендлеру."""
+    with metrics.timer('handler_seconds', handler=data['handler'].callback.__name__):
+        return await handler(event, data)
+
+dp.message.middleware(handler_timing_middleware)
+dp.callback_query.middleware(handler_timing_middleware)
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого запроса к Telegram API."""
+
+    async def __call__(self, make_request, bot, method):
+        with metrics.timer('telegram_api_seconds', method=type(method).__name__):
+            return await make_request(bot, method)
+
+if bot:
+    bot.session.middleware(TelegramTimingMiddleware())
+
+loop_lag = {'last': 0.0}
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """Фоновая задача: насколько позже запланированного просыпается event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        loop_lag['last'] = lag
+        metrics.observe('event_loop_lag_seconds', lag)
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> Counter:
+    """Сэмплирующий профайлер: раз в interval снимает стеки всех потоков (формат collapsed stacks)."""
+    me = threading.get_ident()
+    samples = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            stack = []
+            while frame is not None:
+                code_ = frame.f_code
+                stack.append(f"{code_.co_name} ({os.path.basename(code_.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            samples[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return samples
+
+# --- ОБЩЕЕ СОСТОЯНИЕ (НЕСКОЛЬКО ВОРКЕРОВ) ---
+# Состояние, которое должно быть видно всем процессам/инстансам бота: сигналы и история,
+# подписки, снимки сигналов, кэш свечей, блокировки фоновых задач.
+# 'memory' — замена для тестов и одного процесса, 'redis' — общий бэкенд для нескольких воркеров.
+
+class StateBackend:
+    """Интерфейс общего key-value хранилища. Значения — bytes, ttl — в секундах."""
+
+    async def close(self):
+        pass
+
+    async def get(self, key: str):
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: float = None):
+        raise NotImplementedError
+
+    async def set_nx(self, key: str, value: bytes, ttl: float = None) -> bool:
+        """Записывает, только если ключа нет. True, если запись сделана (используется как блокировка)."""
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def sadd(self, key: str, member: str):
+        raise NotImplementedError
+
+    async def srem(self, key: str, member: str):
+        raise NotImplementedError
+
+    async def smembers(self, key: str) -> set:
+        raise NotImplementedError
+
+    async def lpush_trim(self, key: str, value: str, maxlen: int):
+        """Добавляет значение в начало списка и обрезает список до maxlen."""
+        raise NotImplementedError
+
+    async def lrange(self, key: str, start: int, stop: int) -> list:
+        raise NotImplementedError
+
+class MemoryStateBackend(StateBackend):
+    """Общее состояние в памяти процесса (один воркер, тесты)."""
+
+    def __init__(self):
+        self._data = {}     # key -> (expires_at или None, value)
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and time.time() >= expires_at:
+            del self._data[key]
+            return None
+        return value
+
+    def _put(self, key, value, ttl):
+        self._data[key] = (time.time() + ttl if ttl else None, value)
+
+    async def get(self, key: str):
+        return self._live(key)
+
+    async def set(self, key: str, value: bytes, ttl: float = None):
+        self._put(key, value, ttl)
+
+    async def set_nx(self, key: str, value: bytes, ttl: float = None) -> bool:
+        if self._live(key) is not None:
+            return False
+        self._put(key, value, ttl)
+        return True
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def sadd(self, key: str, member: str):
+        members = self._live(key)
+        if members is None:
+            members = set()
+            self._put(key, members, None)
+        members.add(member)
+
+    async def srem(self, key: str, member: str):
+        members = self._live(key)
+        if members is not None:
+            members.discard(member)
+
+    async def smembers(self, key: str) -> set:
+        return set(self._live(key) or ())
+
+    async def lpush_trim(self, key: str, value: str, maxlen: int):
+        items = self._live(key)
+        if items is None:
+            items = deque(maxlen=maxlen)
+            self._put(key, items, None)
+        items.appendleft(value)
+
+    async def lrange(self, key: str, start: int, stop: int) -> list:
+        items = list(self._live(key) or ())
+        return items[start:stop + 1 if stop >= 0 else None]
+
+class RedisStateBackend(StateBackend):
+    """Общее состояние в Redis (пакет redis — необязательная зависимость, нужна только для этого режима)."""
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis требует пакет redis (pip install redis)")
+        self._redis = redis_asyncio.from_url(url)
+
+    async def close(self):
+        await self._redis.aclose()
+
+    async def get(self, key: str):
+        return await self._redis.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float = None):
+        await self._redis.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def set_nx(self, key: str, value: bytes, ttl: float = None) -> bool:
+        return bool(await self._redis.set(key, value, px=int(ttl * 1000) if ttl else None, nx=True))
+
+    async def delete(self, key: str):
+        await self._redis.delete(key)
+
+    async def sadd(self, key: str, member: str):
+        await self._redis.sadd(key, member)
+
+    async def srem(self, key: str, member: str):
+        await self._redis.srem(key, member)
+
+    async def smembers(self, key: str) -> set:
+        return {m.decode() for m in await self._redis.smembers(key)}
+
+    async def lpush_trim(self, key: str, value: str, maxlen: int):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            await pipe.lpush(key, value).ltrim(key, 0, maxlen - 1).execute()
+
+    async def lrange(self, key: str, start: int, stop: int) -> list:
+        return [v.decode() for v in await self._redis.lrange(key, start, stop)]
+
+def create_state_backend() -> StateBackend:
+    if STATE_BACKEND == 'redis':
+        return RedisStateBackend(STATE_BACKEND_URL)
+    return MemoryStateBackend()
+
+state_backend = create_state_backend()
+
+# --- ХРАНИЛИЩЕ ИСТОРИИ СИГНАЛОВ ---
+
+class HistoryStore:
+    """Интерфейс хранилища истории сигналов. Записи — dict с полями user_id/symbol/direction/confidence/timestamp/result."""
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def add(self, signal_id: str, entry: dict):
+        raise NotImplementedError
+
+    async def get(self, signal_id: str):
+        """Запись по signal_id или None."""
+        raise NotImplementedError
+
+    async def set_result(self, signal_id: str, result: str) -> bool:
+        """Фиксирует результат, только если сигнал еще 'Pending'. True, если результат записан."""
+        raise NotImplementedError
+
+    async def recent(self, user_id: int, limit: int = 10) -> list:
+        """Последние записи пользователя, новые первыми."""
+        raise NotImplementedError
+
+    async def compact(self):
+        """Удаляет записи старше срока хранения и сверх лимита на пользователя."""
+        pass
+
+    def pending_writes(self) -> int:
+        """Сколько записей ждут пакетной записи."""
+        return 0
+
+class InMemoryHistoryStore(HistoryStore):
+    """История в памяти процесса (для отладки и тестов): индекс по пользователю, лимит на пользователя."""
+
+    def __init__(self, max_per_user: int = HISTORY_MAX_PER_USER):
+        self.max_per_user = max_per_user
+        self._entries = {}   # signal_id -> entry
+        self._by_user = {}   # user_id -> deque(signal_id), старые слева
+
+    async def add(self, signal_id: str, entry: dict):
+        ids = self._by_user.setdefault(entry['user_id'], deque())
+        ids.append(signal_id)
+        self._entries[signal_id] = entry
+        while len(ids) > self.max_per_user:
+            self._entries.pop(ids.popleft(), None)
+
+    async def get(self, signal_id: str):
+        return self._entries.get(signal_id)
+
+    async def set_result(self, signal_id: str, result: str) -> bool:
+        entry = self._entries.get(signal_id)
+        if entry is None or entry['result'] != 'Pending':
+            return False
+        entry['result'] = result
+        return True
+
+    async def recent(self, user_id: int, limit: int = 10) -> list:
+        ids = self._by_user.get(user_id, ())
+        return [self._entries[i] for i in list(reversed(ids))[:limit]]
+
+    async def compact(self):
+        cutoff = datetime.now(TZ) - timedelta(days=HISTORY_RETENTION_DAYS)
+        for ids in self._by_user.values():
+            while ids and self._entries[ids[0]]['timestamp'] < cutoff:
+                self._entries.pop(ids.popleft())
+
+class SQLiteHistoryStore(HistoryStore):
+    """История в SQLite (WAL). Новые записи копятся в буфере и пишутся пачкой раз в HISTORY_FLUSH_INTERVAL.
+
+    Все обращения к базе идут через один поток, поэтому запросы выполняются строго по очереди
+    и не блокируют event loop.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS history (
+            signal_id  TEXT PRIMARY KEY,
+            user_id    INTEGER NOT NULL,
+            symbol     TEXT NOT NULL,
+            direction  TEXT NOT NULL,
+            confidence TEXT NOT NULL,
+            timestamp  REAL NOT NULL,
+            result     TEXT NOT NULL DEFAULT 'Pending'
+        );
+        CREATE INDEX IF NOT EXISTS idx_history_user_ts ON history (user_id, timestamp DESC);
+        CREATE INDEX IF NOT EXISTS idx_history_ts ON history (timestamp);
+    """
+    COLUMNS = ('signal_id', 'user_id', 'symbol', 'direction', 'confidence', 'timestamp', 'result')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+        self._pending = {}  # signal_id -> entry, еще не записанные в базу
+        self._tasks = []
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+
+    async def start(self):
+        await self._run(self._open)
+        self._tasks = [
+            asyncio.create_task(self._periodic(self.flush, HISTORY_FLUSH_INTERVAL)),
+            asyncio.create_task(self._periodic(self.compact, HISTORY_COMPACT_INTERVAL)),
+        ]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await self.flush()
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
+
+    async def _periodic(self, func, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await func()
+            except Exception as e:
+                print(f"❌ Ошибка обслуживания истории ({func.__name__}): {e}")
+
+    def _row(self, signal_id: str, entry: dict) -> tuple:
+        return (signal_id, entry['user_id'], entry['symbol'], entry['direction'],
+                entry['confidence'], entry['timestamp'].timestamp(), entry['result'])
+
+    def _entry(self, row) -> dict:
+        entry = dict(zip(self.COLUMNS, row))
+        entry['timestamp'] = datetime.fromtimestamp(entry['timestamp'], TZ)
+        return entry
+
+    async def add(self, signal_id: str, entry: dict):
+        self._pending[signal_id] = entry
+
+    def pending_writes(self) -> int:
+        return len(self._pending)
+
+    async def flush(self):
+        """Записывает накопленный буфер одной транзакцией."""
+        if not self._pending:
+            return
+        # Буфер забираем и отдаем в поток без await между ними: следующие запросы встанут в очередь после записи
+        batch, self._pending = self._pending, {}
+        rows = [self._row(signal_id, entry) for signal_id, entry in batch.items()]
+        await self._run(self._write, rows)
+
+    def _write(self, rows):
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO history ({', '.join(self.COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    async def get(self, signal_id: str):
+        if signal_id in self._pending:
+            return self._pending[signal_id]
+        row = await self._run(self._fetchone, f"SELECT {', '.join(self.COLUMNS)} FROM history WHERE signal_id = ?", (signal_id,))
+        return self._entry(row) if row else None
+
+    def _fetchone(self, sql, params):
+        return self._conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        return self._conn.execute(sql, params).fetchall()
+
+    async def set_result(self, signal_id: str, result: str) -> bool:
+        entry = self._pending.get(signal_id)
+        if entry is not None:
+            if entry['result'] != 'Pending':
+                return False
+            entry['result'] = result
+            return True
+        return await self._run(self._update_result, signal_id, result)
+
+    def _update_result(self, signal_id, result) -> bool:
+        with self._conn:
+            cursor = self._conn.execute(
+                "UPDATE history SET result = ? WHERE signal_id = ? AND result = 'Pending'", (result, signal_id)
+            )
+        return cursor.rowcount == 1
+
+    async def recent(self, user_id: int, limit: int = 10) -> list:
+        rows = await self._run(
+            self._fetchall,
+            f"SELECT {', '.join(self.COLUMNS)} FROM history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
+            (user_id, limit),
+        )
+        entries = [self._entry(row) for row in rows]
+        entries += [e for e in self._pending.values() if e['user_id'] == user_id]
+        entries.sort(key=lambda e: e['timestamp'], reverse=True)
+        return entries[:limit]
+
+    async def compact(self):
+        cutoff = (datetime.now(TZ) - timedelta(days=HISTORY_RETENTION_DAYS)).timestamp()
+        removed = await self._run(self._compact, cutoff, HISTORY_MAX_PER_USER)
+        if removed:
+            print(f"🧹 История: удалено {removed} старых записей")
+
+    def _compact(self, cutoff: float, max_per_user: int) -> int:
+        with self._conn:
+            removed = self._conn.execute("DELETE FROM history WHERE timestamp < ?", (cutoff,)).rowcount
+            removed += self._conn.execute("""
+                DELETE FROM history WHERE signal_id IN (
+                    SELECT signal_id FROM (
+                        SELECT signal_id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC) AS rn
+                        FROM history
+                    ) WHERE rn > ?
+                )
+            """, (max_per_user,)).rowcount
+        # Сжимаем WAL, чтобы файл журнала не рос между чекпойнтами
+        self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return removed
+
+class SharedHistoryStore(HistoryStore):
+    """История в общем бэкенде: сигнал, созданный одним воркером, виден и фиксируется на любом другом.
+
+    Срок хранения — TTL ключей, лимит на пользователя — обрезка списка, поэтому compact() не нужен.
+    """
+
+    def __init__(self, backend: StateBackend):
+        self.backend = backend
+        self.ttl = HISTORY_RETENTION_DAYS * 86400
+
+    async def _save(self, signal_id: str, entry: dict):
+        data = dict(entry, timestamp=entry['timestamp'].timestamp())
+        await self.backend.set(f'signal:{signal_id}', json.dumps(data).encode(), ttl=self.ttl)
+
+    async def add(self, signal_id: str, entry: dict):
+        await self._save(signal_id, entry)
+        await self.backend.lpush_trim(f'history:{entry["user_id"]}', signal_id, HISTORY_MAX_PER_USER)
+
+    async def get(self, signal_id: str):
+        raw = await self.backend.get(f'signal:{signal_id}')
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        entry['timestamp'] = datetime.fromtimestamp(entry['timestamp'], TZ)
+        return entry
+
+    async def set_result(self, signal_id: str, result: str) -> bool:
+        entry = await self.get(signal_id)
+        if entry is None or entry['result'] != 'Pending':
+            return False
+        # Атомарная отметка: из двух одновременных нажатий (в т.ч. на разных воркерах) пройдет одно
+        if not await self.backend.set_nx(f'signal:{signal_id}:result', result.encode(), ttl=self.ttl):
+            return False
+        entry['result'] = result
+        await self._save(signal_id, entry)
+        return True
+
+    async def recent(self, user_id: int, limit: int = 10) -> list:
+        ids = await self.backend.lrange(f'history:{user_id}', 0, limit - 1)
+        entries = [await self.get(signal_id) for signal_id in ids]
+        return [e for e in entries if e is not None]  # Истекшие по TTL сигналы пропускаем
+
+def create_history_store() -> HistoryStore:
+    if HISTORY_BACKEND == 'shared':
+        return SharedHistoryStore(state_backend)
+    if HISTORY_BACKEND == 'memory':
+        return InMemoryHistoryStore()
+    return SQLiteHistoryStore(HISTORY_DB_PATH)
+
+history_store = create_history_store()
+
+# --- ПОДПИСКИ НА СИГНАЛЫ ---
+
+class SubscriptionStore:
+    """Подписки пользователей на пары (в памяти). Индекс в обе стороны: пара -> пользователи и пользователь -> пары."""
+
+    def __init__(self):
+        self._by_pair = {}  # пара -> set(user_id)
+        self._by_user = {}  # user_id -> set(пара)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def _set(self, user_id: int, symbol: str, subscribed: bool):
+        users = self._by_pair.setdefault(symbol, set())
+        pairs = self._by_user.setdefault(user_id, set())
+        if subscribed:
+            users.add(user_id)
+            pairs.add(symbol)
+        else:
+            users.discard(user_id)
+            pairs.discard(symbol)
+
+    async def toggle(self, user_id: int, symbol: str) -> bool:
+        """Подписывает или отписывает пользователя. True, если теперь подписан."""
+        subscribed = symbol not in await self.pairs_for(user_id)
+        self._set(user_id, symbol, subscribed)
+        return subscribed
+
+    async def pairs_for(self, user_id: int) -> set:
+        return self._by_user.get(user_id, set())
+
+    async def subscribers(self, symbol: str) -> set:
+        return self._by_pair.get(symbol, set())
+
+class SQLiteSubscriptionStore(SubscriptionStore):
+    """Подписки с сохранением в SQLite (та же база, что и история). Чтение — из индекса в памяти."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='subscriptions')
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _load(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions (user_id INTEGER NOT NULL, symbol TEXT NOT NULL, PRIMARY KEY (user_id, symbol))"
+        )
+        return self._conn.execute("SELECT user_id, symbol FROM subscriptions").fetchall()
+
+    async def start(self):
+        for user_id, symbol in await self._run(self._load):
+            self._set(user_id, symbol, True)
+
+    async def close(self):
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
+
+    def _write(self, user_id: int, symbol: str, subscribed: bool):
+        with self._conn:
+            if subscribed:
+                self._conn.execute("INSERT OR IGNORE INTO subscriptions (user_id, symbol) VALUES (?, ?)", (user_id, symbol))
+            else:
+                self._conn.execute("DELETE FROM subscriptions WHERE user_id = ? AND symbol = ?", (user_id, symbol))
+
+    async def toggle(self, user_id: int, symbol: str) -> bool:
+        subscribed = await super().toggle(user_id, symbol)
+        await self._run(self._write, user_id, symbol, subscribed)
+        return subscribed
+
+class SharedSubscriptionStore(SubscriptionStore):
+    """Подписки в общем бэкенде: рассылку делает воркер, который прогревает данные, а подписка могла прийти на любой."""
+
+    def __init__(self, backend: StateBackend):
+        super().__init__()
+        self.backend = backend
+
+    async def toggle(self, user_id: int, symbol: str) -> bool:
+        subscribed = symbol not in await self.pairs_for(user_id)
+        if subscribed:
+            await self.backend.sadd(f'subs:user:{user_id}', symbol)
+            await self.backend.sadd(f'subs:pair:{symbol}', str(user_id))
+        else:
+            await self.backend.srem(f'subs:user:{user_id}', symbol)
+            await self.backend.srem(f'subs:pair:{symbol}', str(user_id))
+        return subscribed
+
+    async def pairs_for(self, user_id: int) -> set:
+        return await self.backend.smembers(f'subs:user:{user_id}')
+
+    async def subscribers(self, symbol: str) -> set:
+        return {int(user_id) for user_id in await self.backend.smembers(f'subs:pair:{symbol}')}
+
+def create_subscription_store() -> SubscriptionStore:
+    if HISTORY_BACKEND == 'shared':
+        return SharedSubscriptionStore(state_backend)
+    if HISTORY_BACKEND == 'memory':
+        return SubscriptionStore()
+    return SQLiteSubscriptionStore(HISTORY_DB_PATH)
+
+subscription_store = create_subscription_store()
+
+# --- ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ---
+
+class SendQueue:
+    """Асинхронная очередь исходящих вызовов Bot API с лимитами Telegram.
+
+    Глобально — не чаще SEND_GLOBAL_RATE вызовов в секунду. Рассылка (send) в один чат — не чаще
+    раза в SEND_CHAT_INTERVAL: рассылка в «остывающий» чат ждет в очереди этого чата (по порядку),
+    не задерживая остальные чаты.
+    Интерактивные ответы (call) идут вне очереди рассылки и ждут результата.
+    На 429 (TelegramRetryAfter) вызов повторяется после retry_after, до SEND_MAX_RETRIES раз.
+    """
+
+    INTERACTIVE, BULK = 0, 1  # Приоритеты: ответ пользователю важнее рассылки алертов
+
+    def __init__(self, global_rate: float, chat_interval: float, max_retries: int, max_inflight: int = 16):
+        self.interval = 1 / global_rate
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._queue = asyncio.PriorityQueue()
+        self._seq = 0            # Порядок FIFO внутри одного приоритета
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._next_send = 0.0   # loop.time(), раньше которого нельзя отправлять следующее сообщение
+        self._next_chat = {}    # chat_id -> loop.time() следующей допустимой отправки
+        self._deferred = {}     # chat_id -> deque рассылки, ждущей остывания чата
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._worker())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def send(self, chat_id: int, text: str, **kwargs):
+        """Ставит сообщение рассылки в очередь (без ожидания отправки)."""
+        self._put((chat_id, 'send_message', dict(kwargs, chat_id=chat_id, text=text), 0, None))
+
+    async def call(self, method: str, chat_id: int, **kwargs):
+        """Интерактивный вызов метода Bot API (send_message, edit_message_text, ...): ждет и возвращает результат."""
+        future = asyncio.get_running_loop().create_future()
+        self._put((chat_id, method, dict(kwargs, chat_id=chat_id), 0, future))
+        return await future
+
+    def _put(self, item, released: bool = False):
+        """released — сообщение из очереди чата, у которого уже подошла очередь (лимит чата не проверяется)."""
+        self._seq += 1
+        priority = self.BULK if item[4] is None else self.INTERACTIVE
+        self._queue.put_nowait((priority, self._seq, item, released))
+
+    def _defer(self, chat_id: int, item, front: bool = False):
+        """Откладывает рассылку в очередь чата; front — вперед очереди (повтор после 429)."""
+        waiting = self._deferred.get(chat_id)
+        if waiting is None:
+            loop = asyncio.get_running_loop()
+            waiting = self._deferred[chat_id] = deque()
+            loop.call_later(max(0.0, self._next_chat.get(chat_id, 0.0) - loop.time()), self._release, chat_id)
+        if front:
+            waiting.appendleft(item)
+        else:
+            waiting.append(item)
+
+    def _release(self, chat_id: int):
+        """Чат остыл: первое отложенное сообщение — в общую очередь, следующее — через SEND_CHAT_INTERVAL."""
+        loop = asyncio.get_running_loop()
+        ready_at = self._next_chat.get(chat_id, 0.0)
+        if ready_at > loop.time():  # Срок сдвинули (429 или ответ пользователю в этот чат)
+            loop.call_later(ready_at - loop.time(), self._release, chat_id)
+            return
+        waiting = self._deferred[chat_id]
+        item = waiting.popleft()
+        if waiting:
+            loop.call_later(self.chat_interval, self._release, chat_id)
+        else:
+            del self._deferred[chat_id]
+        self._put(item, released=True)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, item, released = await self._queue.get()
+            chat_id, future = item[0], item[4]
+            now = loop.time()
+
+            # Лимит на чат откладывает только рассылку: интерактивный ответ пользователь уже ждет.
+            # Пока у чата есть отложенные сообщения, новые встают за ними, чтобы алерты пришли по порядку
+            if future is None and not released and (
+                    chat_id in self._deferred or self._next_chat.get(chat_id, 0.0) > now):
+                self._defer(chat_id, item)
+                continue
+
+            if self._next_send > now:
+                await asyncio.sleep(self._next_send - now)
+            self._next_send = max(now, self._next_send) + self.interval
+            self._next_chat[chat_id] = loop.time() + self.chat_interval
+            if len(self._next_chat) > 10000:
+                self._next_chat = {k: t for k, t in self._next_chat.items() if t > now}
+
+            await self._inflight.acquire()
+            asyncio.create_task(self._deliver(item))
+
+    async def _deliver(self, item):
+        chat_id, method, kwargs, attempt, future = item
+        try:
+            result = await getattr(bot, method)(**kwargs)
+            if future is not None and not future.done():
+                future.set_result(result)
+        except TelegramRetryAfter as e:
+            loop = asyncio.get_running_loop()
+            self._next_chat[chat_id] = loop.time() + e.retry_after
+            retry = (chat_id, method, kwargs, attempt + 1, future)
+            if attempt < self.max_retries and future is None:
+                self._defer(chat_id, retry, front=True)  # Рассылка повторяется раньше следующих сообщений чата
+            elif attempt < self.max_retries:
+                loop.call_later(e.retry_after, self._put, retry)
+            else:
+                print(f"❌ {method} в чат {chat_id} не выполнен после {attempt + 1} попыток (429)")
+                if future is not None and not future.done():
+                    future.set_exception(e)
+        except Exception as e:
+            if future is not None:
+                # Ошибку разбирает тот, кто ждет ответа (например, «message is not modified»)
+                if not future.done():
+                    future.set_exception(e)
+            elif isinstance(e, TelegramForbiddenError):
+                print(f"Чат {chat_id} заблокировал бота, сообщение пропущено")
+            else:
+                print(f"❌ Ошибка отправки в чат {chat_id}: {e}")
+        finally:
+            self._inflight.release()
+
+send_queue = SendQueue(SEND_GLOBAL_RATE, SEND_CHAT_INTERVAL, SEND_MAX_RETRIES)
+
+# --- ЛОКАЛЬНОЕ ХРАНИЛИЩЕ СВЕЧЕЙ ---
+# Каталог на (тикер, таймфрейм), в нем по файлу на колонку: ts (int64, нс UTC) и
+# open/high/low/close/volume (float64) фиксированной ширины. Чтение — через np.memmap,
+# без разбора и копирования; запись — только дозапись закрытых баров в конец файлов.
+
+BAR_COLUMNS = ('open', 'high', 'low', 'close', 'volume')
+
+class BarStore:
+    """Колоночное хранилище закрытых баров с дозаписью. Безопасно для потоков и процессов (flock)."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, ticker: str, timeframe: str, column: str) -> str:
+        return os.path.join(self.root, f'{ticker}_{timeframe}', column)
+
+    def _map(self, ticker: str, timeframe: str, column: str, dtype: str):
+        path = self._path(ticker, timeframe, column)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def _length(self, ticker: str, timeframe: str) -> int:
+        """Число полных строк: ts дописывается последним, поэтому строка без ts не считается."""
+        sizes = []
+        for column in ('ts',) + BAR_COLUMNS:
+            path = self._path(ticker, timeframe, column)
+            sizes.append(os.path.getsize(path) if os.path.exists(path) else 0)
+        return min(sizes) // 8
+
+    def last_ts(self, ticker: str, timeframe: str):
+        """Время открытия последнего сохраненного бара (pd.Timestamp UTC) или None."""
+        n = self._length(ticker, timeframe)
+        if n == 0:
+            return None
+        return pd.Timestamp(int(self._map(ticker, timeframe, 'ts', '<i8')[n - 1]), tz='UTC')
+
+    def read(self, ticker: str, timeframe: str, since=None) -> pd.DataFrame:
+        """Бары начиная с since; колонки — представления memmap (только чтение)."""
+        n = self._length(ticker, timeframe)
+        if n == 0:
+            return pd.DataFrame(columns=list(BAR_COLUMNS))
+        ts = self._map(ticker, timeframe, 'ts', '<i8')[:n]
+        start = int(np.searchsorted(ts, since.as_unit('ns').value)) if since is not None else 0
+        index = pd.DatetimeIndex(np.asarray(ts[start:]).view('datetime64[ns]')).tz_localize('UTC')
+        columns = {column: self._map(ticker, timeframe, column, '<f8')[start:n] for column in BAR_COLUMNS}
+        return pd.DataFrame(columns, index=index, copy=False)
+
+    def append(self, ticker: str, timeframe: str, df: pd.DataFrame) -> int:
+        """Дописывает бары новее последнего сохраненного. Возвращает число записанных баров."""
+        directory = os.path.dirname(self._path(ticker, timeframe, 'ts'))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            last = self.last_ts(ticker, timeframe)
+            if last is not None:
+                df = df[df.index > last]
+            if df.empty:
+                return 0
+            # Хвост оборванной записи (значения без ts) отрезаем, иначе новые строки сдвинутся
+            size = self._length(ticker, timeframe) * 8
+            for column in ('ts',) + BAR_COLUMNS:
+                path = self._path(ticker, timeframe, column)
+                if os.path.exists(path) and os.path.getsize(path) > size:
+                    os.truncate(path, size)
+            # Колонки значений пишем до ts: строка считается записанной, когда есть ее ts
+            for column in BAR_COLUMNS:
+                with open(self._path(ticker, timeframe, column), 'ab') as f:
+                    f.write(df[column].to_numpy(dtype='<f8').tobytes())
+            with open(self._path(ticker, timeframe, 'ts'), 'ab') as f:
+                f.write(df.index.as_unit('ns').asi8.astype('<i8').tobytes())  # pandas 3: индекс бывает в s/us
+            return len(df)
+
+    def merge(self, ticker: str, timeframe: str, fresh: pd.DataFrame, days: int) -> pd.DataFrame:
+        """Сохраняет закрытые бары свежей загрузки и отдает историю за days дней + формирующийся бар."""
+        now = pd.Timestamp.now(tz='UTC')
+        if not fresh.empty:
+            fresh = fresh.tz_convert('UTC') if fresh.index.tz is not None else fresh.tz_localize('UTC')
+            fresh = fresh.set_axis(fresh.index.as_unit('ns'))  # Как у истории из хранилища
+            closed = fresh.index + pd.Timedelta(seconds=TIMEFRAME_SECONDS[timeframe]) <= now
+            self.append(ticker, timeframe, fresh[closed])
+            forming = fresh[~closed]
+        else:
+            forming = fresh
+        history = self.read(ticker, timeframe, since=now - pd.Timedelta(days=days))
+        if forming.empty or history.empty:
+            return history if forming.empty else forming
+        return pd.concat([history, forming])
+
+    def download_start(self, tickers, timeframe: str):
+        """С какого момента докачивать пакет тикеров: с самого старого "последнего бара" среди них.
+        None — если хоть у одного тикера нет истории или пропуск больше, чем отдает Yfinance."""
+        starts = [self.last_ts(ticker, timeframe) for ticker in tickers]
+        if not starts or None in starts:
+            return None
+        start = min(starts)
+        if pd.Timestamp.now(tz='UTC') - start >= pd.Timedelta(days=YF_MAX_DAYS[timeframe] - 1):
+            return None
+        return start
+
+bar_store = BarStore(BAR_STORE_DIR) if BAR_STORE_DIR else None
+
+def period_days(period: str) -> int:
+    """Период в формате Yfinance ('60d', '3mo', '2y') в днях."""
+    for suffix, days in (('mo', 30), ('d', 1), ('y', 365)):
+        if period.endswith(suffix):
+            return int(period[:-len(suffix)]) * days
+    raise ValueError(f"Неизвестный период: {period}")
+
+# --- ПОСТАВЩИКИ РЫНОЧНЫХ ДАННЫХ ---
+# get_ohlcv не привязан к Yfinance: свечи запрашиваются по цепочке поставщиков DATA_PROVIDERS.
+# У каждого поставщика своя статистика и предохранитель; если первый не ответил за
+# PROVIDER_HEDGE_AFTER сек, тот же запрос параллельно уходит следующему (хеджирование),
+# а при ошибке — сразу следующему (failover). Берется первый успешный ответ.
+
+class DataProviderError(Exception):
+    """Поставщик (или вся цепочка) не смог отдать свечи."""
+
+class MarketDataProvider:
+    """Интерфейс поставщика свечей."""
+
+    name = 'base'
+
+    def fetch(self, tickers: list, timeframe: str, start, days: int) -> dict:
+        """Свечи с момента start (или за последние days дней). Возвращает {тикер: df}, при сбое — DataProviderError."""
+        raise NotImplementedError
+
+class YFinanceProvider(MarketDataProvider):
+    name = 'yfinance'
+
+    def fetch(self, tickers: list, timeframe: str, start, days: int) -> dict:
+        window = {'start': start.to_pydatetime()} if start is not None else {'period': f'{days}d'}
+        try:
+            data = yf.download(
+                tickers=tickers,
+                interval=timeframe,
+                auto_adjust=False,
+                progress=False,
+                group_by='ticker',  # Колонки вида (тикер, поле)
+                **window
+            )
+        except Exception as e:
+            raise DataProviderError(f"Yfinance: {e}") from e
+
+        frames = {}
+        loaded = set(data.columns.get_level_values(0)) if isinstance(data.columns, pd.MultiIndex) else set()
+        for ticker_symbol in tickers:
+            if ticker_symbol not in loaded:
+                continue
+            try:
+                frames[ticker_symbol] = _normalize_ohlcv(data[ticker_symbol])
+            except Exception as e:
+                print(f"Ошибка разбора данных Yfinance для {ticker_symbol}: {e}")
+        if not any(not df.empty for df in frames.values()):
+            raise DataProviderError(f"Yfinance: пустой ответ ({', '.join(tickers)})")
+        return frames
+
+class ReplayProvider(MarketDataProvider):
+    """Записанные свечи из файлов (как у бэктеста и бенчмарка) — для тестов и нагрузки без сети.
+
+    Файлы ищутся в data_dir/<таймфрейм>/ и data_dir/. Ряд сдвигается во времени так, что его
+    последний бар — текущий формирующийся, поэтому кэш, прогрев и снимки работают как с живыми данными.
+    Вместе с bar_store лучше задавать отдельный BAR_STORE_DIR, чтобы не смешивать запись с живой историей.
+    """
+
+    name = 'replay'
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self._frames = {}  # (тикер, таймфрейм) -> df как в файле
+        self._lock = threading.Lock()
+
+    def _load(self, ticker: str, timeframe: str):
+        key = (ticker, timeframe)
+        with self._lock:
+            if key not in self._frames:
+                # Файл называется тикером (EURUSD=X.csv) или парой (EUR_USD.csv)
+                names = [ticker] + [pair.replace('/', '_') for pair, t in PAIRS_TICKERS.items() if t == ticker]
+                path = None
+                for directory in (os.path.join(self.data_dir, timeframe), self.data_dir):
+                    path = next(filter(None, (find_ohlcv_file(directory, name) for name in names)), None)
+                    if path:
+                        break
+                df = read_ohlcv_file(path) if path else None
+                if df is not None:
+                    df = df.tz_convert('UTC') if df.index.tz is not None else df.tz_localize('UTC')
+                self._frames[key] = df
+            return self._frames[key]
+
+    def fetch(self, tickers: list, timeframe: str, start, days: int) -> dict:
+        bar = pd.Timedelta(seconds=TIMEFRAME_SECONDS[timeframe])
+        now = pd.Timestamp.now(tz='UTC')
+        since = start if start is not None else now - pd.Timedelta(days=days)
+        frames = {}
+        for ticker_symbol in tickers:
+            df = self._load(ticker_symbol, timeframe)
+            if df is None or df.empty:
+                continue
+            shifted = df.set_axis(df.index + ((now - df.index[-1]) // bar) * bar)
+            frames[ticker_symbol] = shifted[shifted.index >= since]
+        if not frames:
+            raise DataProviderError(f"Replay: нет файлов в {self.data_dir} ({', '.join(tickers)})")
+        return frames
+
+class ProviderHealth:
+    """Статистика поставщика и предохранитель (circuit breaker).
+
+    closed — запросы идут; после failure_threshold ошибок подряд — open (поставщик пропускается);
+    через reset_timeout — half_open: один пробный запрос решает, вернуться в closed или снова в open.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.stats = {'successes': 0, 'failures': 0, 'skipped': 0}
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                return True
+            if self.state == 'closed':
+                return True
+            self.stats['skipped'] += 1
+            return False
+
+    def record(self, ok: bool, seconds: float):
+        metrics.observe('provider_seconds', seconds, provider=self.name, outcome='ok' if ok else 'error')
+        with self._lock:
+            if ok:
+                self.stats['successes'] += 1
+                self.consecutive_failures = 0
+                self.state = 'closed'
+                return
+            self.stats['failures'] += 1
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f"⚠️ Поставщик {self.name} отключен на {self.reset_timeout:.0f} сек после {self.consecutive_failures} ошибок")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+class ProviderChain:
+    """Цепочка поставщиков с хеджированием и failover. Вызывается из потоков analysis_executor."""
+
+    def __init__(self, providers: list, hedge_after: float):
+        self.providers = providers
+        self.health = {p.name: ProviderHealth(p.name, PROVIDER_FAILURE_THRESHOLD, PROVIDER_RESET_TIMEOUT) for p in providers}
+        self.hedge_after = hedge_after
+        self._executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS * len(providers), thread_name_prefix='provider')
+
+    def _call(self, provider: MarketDataProvider, *args) -> dict:
+        started = time.perf_counter()
+        try:
+            frames = provider.fetch(*args)
+        except Exception:
+            self.health[provider.name].record(False, time.perf_counter() - started)
+            raise
+        self.health[provider.name].record(True, time.perf_counter() - started)
+        return frames
+
+    def fetch(self, tickers: list, timeframe: str, start, days: int) -> dict:
+        """Первый успешный ответ среди доступных поставщиков; если ответа нет ни от кого — DataProviderError."""
+        candidates = iter(self.providers)
+        pending, errors = {}, []
+
+        def launch():
+            # allow() — только перед самим запросом: для open он переводит поставщика в half_open,
+            # и пробный запрос должен действительно уйти, иначе предохранитель залипнет в half_open
+            provider = next((p for p in candidates if self.health[p.name].allow()), None)
+            if provider is not None:
+                pending[self._executor.submit(self._call, provider, tickers, timeframe, start, days)] = provider
+            return provider is not None
+
+        if not launch():
+            raise DataProviderError("все поставщики временно отключены предохранителем")
+        while pending:
+            # Отстающие запросы не отменяем: их результат все равно попадет в статистику поставщика
+            done, _ = wait(pending, timeout=self.hedge_after, return_when=FIRST_COMPLETED)
+            if not done:
+                launch()  # Хеджирование: дублируем запрос следующему поставщику
+                continue
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    errors.append(f"{provider.name}: {e}")
+            if not pending:
+                launch()  # Failover
+        raise DataProviderError("; ".join(errors))
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def create_provider(name: str) -> MarketDataProvider:
+    if name == 'yfinance':
+        return YFinanceProvider()
+    if name == 'replay':
+        return ReplayProvider(REPLAY_DATA_DIR)
+    raise ValueError(f"Неизвестный поставщик данных: {name}")
+
+provider_chain = ProviderChain([create_provider(name.strip()) for name in DATA_PROVIDERS], PROVIDER_HEDGE_AFTER)
+
+# --- 2. ФУНКЦИИ АНАЛИЗА И ПРОВЕРКИ ---
+
+def is_weekend():
+    """Проверяет, является ли текущий день субботой (5) или воскресеньем (6)."""
+    if not WEEKEND_BLOCK:
+        return False
+    now = datetime.now(TZ)
+    return now.weekday() >= 5
+
+@timed('stage_seconds', stage='fetch')
+def get_ohlcv(symbol: str, timeframe=BASE_TIMEFRAME):
+    """Получение исторических данных OHLCV через цепочку поставщиков (DataProviderError, если данных нет нигде)."""
+    if symbol not in PAIRS_TICKERS:
+        return pd.DataFrame()
+    return _load_ohlcv({PAIRS_TICKERS[symbol]: symbol}, timeframe, LIMIT_DAYS).get(symbol, pd.DataFrame())
+
+@timed('stage_seconds', stage='fetch_batch')
+def get_ohlcv_batch(symbols, timeframe=BASE_TIMEFRAME, period=LIMIT_DAYS):
+    """Получение OHLCV сразу для нескольких пар одним запросом к поставщику. Возвращает {пара: df}."""
+    tickers = {PAIRS_TICKERS[s]: s for s in symbols if s in PAIRS_TICKERS}
+    if not tickers:
+        return {}
+    return _load_ohlcv(tickers, timeframe, period)
+
+def _load_ohlcv(tickers: dict, timeframe: str, period: str) -> dict:
+    """Загрузка {тикер: пара} одним запросом; при включенном bar_store — только недостающих баров."""
+    days = period_days(period)
+    start = bar_store.download_start(list(tickers), timeframe) if bar_store else None
+    try:
+        fresh = provider_chain.fetch(list(tickers), timeframe, start, min(days, YF_MAX_DAYS[timeframe]))
+    except DataProviderError as e:
+        if bar_store is None:
+            raise
+        print(f"⚠️ Поставщики недоступны ({e}), отдаю сохраненную историю")
+        fresh, failure = {}, e
+    else:
+        failure = None
+
+    frames = {}
+    for ticker_symbol, symbol in tickers.items():
+        df = fresh.get(ticker_symbol)
+        if bar_store is None:
+            if df is not None:
+                frames[symbol] = df
+            continue
+        # Если поставщики недоступны, отдаем хотя бы сохраненную историю
+        try:
+            df = bar_store.merge(ticker_symbol, timeframe, df if df is not None else pd.DataFrame(), days)
+        except Exception as e:
+            print(f"Ошибка хранилища свечей для {symbol}: {e}")
+            continue
+        if not df.empty:
+            frames[symbol] = df
+    if failure is not None and not frames:
+        raise failure
+    return frames
+
+def find_ohlcv_file(data_dir: str, name: str):
+    """Файл свечей name.parquet или name.csv в папке data_dir (None, если нет)."""
+    for ext in ('.parquet', '.csv'):
+        path = os.path.join(data_dir, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+def read_ohlcv_file(path: str) -> pd.DataFrame:
+    """Чтение сохраненных свечей из Parquet или CSV (формат как у выгрузки Yfinance)."""
+    if path.endswith('.parquet'):
+        data = pd.read_parquet(path)
+    else:
+        data = pd.read_csv(path, index_col=0, parse_dates=True)
+    return _normalize_ohlcv(data)
+
+def resample_ohlcv(df: pd.DataFrame, timeframe: str, base=BASE_TIMEFRAME) -> pd.DataFrame:
+    """Собирает бары старшего таймфрейма из баров base (последний бар — формирующийся)."""
+    if timeframe == base:
+        return df
+    return df.resample(RESAMPLE_RULES[timeframe], label='left', closed='left').agg({
+        'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum',
+    }).dropna()
+
+def _normalize_ohlcv(data: pd.DataFrame) -> pd.DataFrame:
+    """Приводит ответ Yfinance к колонкам open/high/low/close/volume."""
+    df = data.dropna()
+    df.columns = df.columns.str.lower()
+    return df[['open', 'high', 'low', 'close', 'volume']]
+
+def analyze_and_predict(df: pd.DataFrame, symbol: str, timeframe=TIMEFRAME):
+    """Основная функция технического анализа (15+ индикаторов)."""
+    if df.empty or len(df) < 50:
+        return None
+
+    compute_indicators(df)
+    return score_signal(df.iloc[-1], symbol, timeframe)
+
+# Цепочка индикаторов pandas_ta: (имя, шаг). Каждый шаг дописывает свои колонки в df.
+INDICATOR_CHAIN = (
+    ('rsi', lambda df: df.ta.rsi(append=True)),
+    ('macd', lambda df: df.ta.macd(append=True)),
+    ('sma_50', lambda df: df.ta.sma(length=50, append=True)),
+    ('ema_20', lambda df: df.ta.ema(length=20, append=True)),
+    ('stoch', lambda df: df.ta.stoch(append=True)),
+    ('adx', lambda df: df.ta.adx(append=True)),
+    ('bbands', lambda df: df.ta.bbands(append=True)),
+    ('obv', lambda df: df.ta.obv(append=True)),
+    ('vwap', lambda df: df.ta.vwap(append=True)),
+)
+
+@timed('stage_seconds', stage='indicators')
+def compute_indicators(df: pd.DataFrame):
+    """Расчет индикаторов pandas_ta (колонки дописываются в df)."""
+    for _, step in INDICATOR_CHAIN:
+        step(df)
+
+# Балльная система: (баллы, условие). Условия работают и со строкой (последний бар),
+# и с целым DataFrame (векторно, для бэктеста), поэтому правила описаны один раз.
+SCORE_RULES = (
+    (2, lambda r: r['MACDh_12_26_9'] > 0),
+    (3, lambda r: r['RSI_14'] < 30),
+    (1, lambda r: r['close'] > r['SMA_50']),
+    (2, lambda r: (r['STOCHk_14_3_3'] < 20) & (r['STOCHd_14_3_3'] < 20)),
+    (2, lambda r: r['close'] < r['BBL_5_2.0_2.0']),
+)
+
+def score_frame(df: pd.DataFrame) -> pd.Series:
+    """Балл сигнала на каждом баре df с уже рассчитанными индикаторами."""
+    return sum(points * rule(df).astype(int) for points, rule in SCORE_RULES)
+
+# Экранированные причины сильных сигналов (собираются один раз)
+STRONG_BUY_REASON = f"Сильный сигнал на покупку\\. {bold(escape_md('RSI, MACD и Stochastic'))} подтверждают восходящее движение\\."
+STRONG_SELL_REASON = f"Сильный сигнал на продажу\\. {bold(escape_md('Индикаторы объемов и тренда'))} указывают на нисходящее движение\\."
+
+def score_signal(last, symbol: str, timeframe=TIMEFRAME, strength_gap=None):
+    """Балльная система и логика определения сигнала по значениям индикаторов на последнем баре.
+
+    strength_gap — перевес силы базовой валюты над котируемой (в сигмах, см. strength_gap()).
+    """
+    score = sum(points for points, rule in SCORE_RULES if rule(last))
+    if STRENGTH_WEIGHT and strength_gap is not None and abs(strength_gap) >= STRENGTH_THRESHOLD:
+        score += STRENGTH_WEIGHT if strength_gap > 0 else -STRENGTH_WEIGHT
+
+    # Определение направления
+    if score >= 6:
+        direction = "ВВЕРХ \\(BUY\\) 🚀"
+        reason = STRONG_BUY_REASON
+    elif score <= -6:
+        direction = "ВНИЗ \\(SELL\\) 👇"
+        reason = STRONG_SELL_REASON
+    elif score > 0:
+        direction = "ВВЕРХ \\(BUY\\) 📈"
+        reason = "Большинство индикаторов поддерживают рост\\."
+    elif score < 0:
+        direction = "ВНИЗ \\(SELL\\) 📉"
+        reason = "Большинство индикаторов поддерживают падение\\."
+    else:
+        direction = NEUTRAL_DIRECTION
+        reason = "Сигналы индикаторов противоречивы, риск слишком высок\\."
+        
+    confidence_base = 65.0
+    confidence = min(99.99, confidence_base + abs(score) * 3) 
+    expiration_time = EXPIRATIONS[timeframe]
+
+    return {
+        'symbol': symbol,
+        'timeframe': timeframe,
+        'score': score,
+        'direction': direction,
+        'confidence': f"{confidence:.2f}\\%",
+        'expiration': expiration_time,
+        'reason': reason,
+        'price': f"{last['close']:.4f}",
+        'strength_gap': strength_gap,
+    }
+
+# --- ИНКРЕМЕНТАЛЬНЫЕ ИНДИКАТОРЫ ---
+# Потоковые версии индикаторов pandas_ta: каждый новый бар обновляет состояние за O(1).
+# Формулы повторяют pandas_ta 0.4.71b0 (SMA-затравка у EMA и ATR, RMA = ewm(alpha=1/n, adjust=False),
+# ddof=1 у BBands), поэтому на тех же барах значения совпадают с df.ta.*.
+
+NAN = float('nan')
+
+class _SMA:
+    def __init__(self, length: int):
+        self.length = length
+        self.window = deque(maxlen=length)
+        self.total = 0.0
+
+    def update(self, x: float) -> float:
+        if len(self.window) == self.length:
+            self.total -= self.window[0]
+        self.window.append(x)
+        self.total += x
+        return self.total / self.length if len(self.window) == self.length else NAN
+
+class _EMA:
+    """EMA pandas_ta: первое значение — SMA первых length баров, дальше ewm(adjust=False)."""
+
+    def __init__(self, length: int):
+        self.length = length
+        self.alpha = 2 / (length + 1)
+        self.count = 0
+        self.value = 0.0
+
+    def update(self, x: float) -> float:
+        self.count += 1
+        if self.count < self.length:
+            self.value += x
+            return NAN
+        if self.count == self.length:
+            self.value = (self.value + x) / self.length
+        else:
+            self.value = self.alpha * x + (1 - self.alpha) * self.value
+        return self.value
+
+class _RMA:
+    """RMA pandas_ta: ewm(alpha=1/length, adjust=False) — значение есть с первого бара, NaN пропускаются."""
+
+    def __init__(self, length: int):
+        self.alpha = 1 / length
+        self.value = NAN
+
+    def update(self, x: float) -> float:
+        if math.isnan(x):
+            return self.value
+        self.value = x if math.isnan(self.value) else self.value + self.alpha * (x - self.value)
+        return self.value
+
+class _RSI:
+    def __init__(self, length: int = 14):
+        self.prev_close = None
+        self.gain = _RMA(length)
+        self.loss = _RMA(length)
+
+    def update(self, close: float) -> float:
+        prev, self.prev_close = self.prev_close, close
+        if prev is None:
+            return NAN
+        diff = close - prev
+        gain = self.gain.update(max(diff, 0.0))
+        loss = self.loss.update(max(-diff, 0.0))
+        return 100 * gain / (gain + loss) if gain + loss else NAN
+
+class _MACD:
+    def __init__(self, fast: int = 12, slow: int = 26, signal: int = 9):
+        self.fast = _EMA(fast)
+        self.slow = _EMA(slow)
+        self.signal = _EMA(signal)
+
+    def update(self, close: float):
+        macd = self.fast.update(close) - self.slow.update(close)
+        if math.isnan(macd):
+            return NAN, NAN, NAN
+        signal = self.signal.update(macd)  # Сигнальная EMA стартует с первого валидного MACD
+        return macd, macd - signal, signal
+
+class _Stoch:
+    def __init__(self, k: int = 14, d: int = 3, smooth_k: int = 3):
+        self.highs = deque(maxlen=k)
+        self.lows = deque(maxlen=k)
+        self.k_ma = _SMA(smooth_k)
+        self.d_ma = _SMA(d)
+
+    def update(self, high: float, low: float, close: float):
+        self.highs.append(high)
+        self.lows.append(low)
+        if len(self.highs) < self.highs.maxlen:
+            return NAN, NAN
+        lowest, highest = min(self.lows), max(self.highs)
+        rng = (highest - lowest) or sys.float_info.epsilon  # non_zero_range из pandas_ta
+        stoch_k = self.k_ma.update(100 * (close - lowest) / rng)
+        if math.isnan(stoch_k):
+            return NAN, NAN
+        return stoch_k, self.d_ma.update(stoch_k)
+
+class _ADX:
+    def __init__(self, length: int = 14):
+        self.length = length
+        self.prev = None  # (high, low, close) предыдущего бара
+        self.ranges = []  # True range первых баров — затравка ATR
+        self.atr = _RMA(length)
+        self.plus = _RMA(length)
+        self.minus = _RMA(length)
+        self.adx = _RMA(length)
+
+    def update(self, high: float, low: float, close: float):
+        prev, self.prev = self.prev, (high, low, close)
+        if prev is None:
+            return NAN, NAN, NAN
+        prev_high, prev_low, prev_close = prev
+
+        true_range = max(high - low, abs(high - prev_close), abs(prev_close - low))
+        if self.ranges is not None:
+            # ATR pandas_ta (presma): первое значение — среднее true range баров 1..length-1
+            self.ranges.append(true_range)
+            if len(self.ranges) < self.length - 1:
+                true_range = NAN
+            else:
+                true_range, self.ranges = sum(self.ranges) / len(self.ranges), None
+        up, dn = high - prev_high, prev_low - low
+        atr = self.atr.update(true_range)
+        plus = self.plus.update(up if up > dn and up > 0 else 0.0)
+        minus = self.minus.update(dn if dn > up and dn > 0 else 0.0)
+        if math.isnan(atr) or not atr:
+            return NAN, NAN, NAN
+
+        dmp, dmn = 100 * plus / atr, 100 * minus / atr
+        if not dmp + dmn:
+            return NAN, dmp, dmn
+        return self.adx.update(100 * abs(dmp - dmn) / (dmp + dmn)), dmp, dmn
+
+class _BBands:
+    def __init__(self, length: int = 5, std: float = 2.0):
+        self.window = deque(maxlen=length)
+        self.std = std
+
+    def update(self, close: float):
+        self.window.append(close)
+        n = self.window.maxlen
+        if len(self.window) < n:
+            return NAN, NAN, NAN, NAN, NAN
+        mid = sum(self.window) / n
+        dev = math.sqrt(sum((x - mid) ** 2 for x in self.window) / (n - 1))  # ddof=1, как в pandas_ta 0.4
+        lower, upper = mid - self.std * dev, mid + self.std * dev
+        width = upper - lower
+        return (lower, mid, upper,
+                100 * width / mid if mid else NAN,
+                (close - lower) / width if width else NAN)
+
+class _OBV:
+    def __init__(self):
+        self.prev_close = None
+        self.value = 0.0
+
+    def update(self, close: float, volume: float) -> float:
+        prev, self.prev_close = self.prev_close, close
+        if prev is None:
+            return NAN  # pandas_ta 0.4: знак первого бара не определен, его объем в сумму не входит
+        if close > prev:
+            self.value += volume
+        elif close < prev:
+            self.value -= volume
+        return self.value
+
+class _VWAP:
+    """VWAP с дневным якорем (как df.ta.vwap(anchor='D'))."""
+
+    def __init__(self):
+        self.day = None
+        self.pv = 0.0
+        self.volume = 0.0
+
+    def update(self, ts, high: float, low: float, close: float, volume: float) -> float:
+        day = ts.date()
+        if day != self.day:
+            self.day, self.pv, self.volume = day, 0.0, 0.0
+        self.pv += (high + low + close) / 3 * volume
+        self.volume += volume
+        return self.pv / self.volume if self.volume else NAN
+
+class IndicatorState:
+    """Состояние всех индикаторов одной пары; update() принимает один бар OHLCV."""
+
+    def __init__(self):
+        self.bars = 0
+        self.last_ts = None
+        self.rsi = _RSI(14)
+        self.macd = _MACD(12, 26, 9)
+        self.sma = _SMA(50)
+        self.ema = _EMA(20)
+        self.stoch = _Stoch(14, 3, 3)
+        self.adx = _ADX(14)
+        self.bbands = _BBands(5, 2.0)
+        self.obv = _OBV()
+        self.vwap = _VWAP()
+
+    def update(self, ts, open_: float, high: float, low: float, close: float, volume: float) -> dict:
+        self.bars += 1
+        self.last_ts = ts
+        macd, macd_hist, macd_signal = self.macd.update(close)
+        stoch_k, stoch_d = self.stoch.update(high, low, close)
+        adx, dmp, dmn = self.adx.update(high, low, close)
+        bbl, bbm, bbu, bbb, bbp = self.bbands.update(close)
+        # Имена ключей совпадают с колонками pandas_ta, чтобы score_signal работал с обоими путями
+        return {
+            'open': open_, 'high': high, 'low': low, 'close': close, 'volume': volume,
+            'RSI_14': self.rsi.update(close),
+            'MACD_12_26_9': macd, 'MACDh_12_26_9': macd_hist, 'MACDs_12_26_9': macd_signal,
+            'SMA_50': self.sma.update(close),
+            'EMA_20': self.ema.update(close),
+            'STOCHk_14_3_3': stoch_k, 'STOCHd_14_3_3': stoch_d,
+            'ADX_14': adx, 'DMP_14': dmp, 'DMN_14': dmn,
+            'BBL_5_2.0_2.0': bbl, 'BBM_5_2.0_2.0': bbm, 'BBU_5_2.0_2.0': bbu, 'BBB_5_2.0_2.0': bbb, 'BBP_5_2.0_2.0': bbp,
+            'OBV': self.obv.update(close, volume),
+            'VWAP_D': self.vwap.update(ts, high, low, close, volume),
+            'bars': self.bars,
+        }
+
+class IndicatorEngine:
+    """Инкрементальные индикаторы по парам.
+
+    Закрытые бары применяются к состоянию один раз. Последний (еще формирующийся) бар
+    Yfinance каждый раз считается на копии состояния, а результат запоминается до смены бара.
+    """
+
+    def __init__(self):
+        self._states = {}  # key -> IndicatorState по закрытым барам
+        self._tips = {}    # key -> (последний бар, значения индикаторов на нем)
+        self._lock = threading.Lock()  # update() вызывается из потоков analysis_executor
+
+    @timed('stage_seconds', stage='indicators_incremental')
+    def update(self, key, df: pd.DataFrame) -> dict:
+        """Досчитывает индикаторы по новым барам df и возвращает значения на последнем баре."""
+        tip = df.iloc[-1]
+        tip_key = (df.index[-1], tuple(tip[['open', 'high', 'low', 'close', 'volume']]))
+
+        with self._lock:
+            cached = self._tips.get(key)
+            if cached is not None and cached[0] == tip_key:
+                return cached[1]
+
+            state = self._states.get(key)
+            closed = df.iloc[:-1]
+            # Новые данные должны продолжать состояние без пропусков, иначе пересчитываем с нуля
+            if (state is None or len(closed) == 0 or state.last_ts < closed.index[0]
+                    or state.last_ts >= df.index[-1]):
+                state = IndicatorState()
+            else:
+                closed = closed[closed.index > state.last_ts]
+
+            for ts, row in zip(closed.index, closed[['open', 'high', 'low', 'close', 'volume']].itertuples(index=False)):
+                state.update(ts, *row)
+            self._states[key] = state
+
+            values = copy.deepcopy(state).update(df.index[-1], *tip_key[1])
+            self._tips[key] = (tip_key, values)
+            return values
+
+indicator_engine = IndicatorEngine()
+
+def analyze_incremental(df: pd.DataFrame, symbol: str, timeframe=TIMEFRAME, strength_gap=None):
+    """То же, что analyze_and_predict, но на инкрементальных индикаторах (без полного пересчета)."""
+    if df.empty or len(df) < 50:
+        return None
+    return score_signal(indicator_engine.update((symbol, timeframe), df), symbol, timeframe, strength_gap)
+
+# --- КЭШ СВЕЧЕЙ ---
+
+def next_bar_close(timeframe: str, now: float = None) -> float:
+    """Unix-время закрытия текущего бара таймфрейма."""
+    bar = TIMEFRAME_SECONDS[timeframe]
+    now = time.time() if now is None else now
+    return (now // bar + 1) * bar
+
+class OHLCVCache:
+    """LRU-кэш свечей с истечением по закрытию бара и объединением одинаковых запросов (single-flight)."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires_at, df)
+        self._inflight = {}            # key -> asyncio.Task текущей загрузки
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'expired': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Возвращает свежий кадр из кэша или None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, df = entry
+        if time.time() >= expires_at:
+            del self._entries[key]
+            self.stats['expired'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return df
+
+    def put(self, key, df: pd.DataFrame, expires_at: float):
+        """Сохраняет кадр и вытесняет самые давно использованные записи сверх лимита."""
+        self._entries[key] = (expires_at, df)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    async def get_or_fetch(self, key, fetch, timeframe: str):
+        """Отдает кадр из кэша; при промахе запускает одну загрузку на все одновременные запросы."""
+        df = self.get(key)
+        if df is not None:
+            self.stats['hits'] += 1
+            return df
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats['misses'] += 1
+            task = asyncio.ensure_future(self._fill(key, fetch, timeframe))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats['coalesced'] += 1
+
+        # shield: отмена одного ожидающего хендлера не отменяет общую загрузку
+        return await asyncio.shield(task)
+
+    async def _fill(self, key, fetch, timeframe: str):
+        df = await fetch()
+        if not df.empty:  # Пустой ответ (ошибка/таймаут) не кэшируем
+            self.put(key, df, next_bar_close(timeframe) + OHLCV_CACHE_GRACE)
+        return df
+
+ohlcv_cache = OHLCVCache(OHLCV_CACHE_SIZE)
+
+def ohlcv_cache_key(symbol: str, timeframe=BASE_TIMEFRAME):
+    return (PAIRS_TICKERS[symbol], timeframe, LIMIT_DAYS)
+
+# --- АСИНХРОННЫЙ СЛОЙ ДОСТУПА К ДАННЫМ ---
+
+analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix='analysis')
+# Ограничивает число задач в очереди пула: лишние запросы ждут здесь, а не копятся в executor
+analysis_semaphore = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+
+async def run_blocking(func, *args, timeout: float):
+    """Выполняет блокирующую функцию в пуле потоков с таймаутом и ограничением параллелизма."""
+    loop = asyncio.get_running_loop()
+    async with analysis_semaphore:
+        # При таймауте/отмене хендлер освобождается сразу, поток доработает в фоне
+        return await asyncio.wait_for(loop.run_in_executor(analysis_executor, func, *args), timeout)
+
+async def get_ohlcv_async(symbol: str, timeframe=BASE_TIMEFRAME):
+    """Неблокирующая версия get_ohlcv."""
+    try:
+        return await run_blocking(get_ohlcv, symbol, timeframe, timeout=FETCH_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise DataProviderError(f"таймаут получения данных для {symbol} ({FETCH_TIMEOUT} сек)")
+
+async def get_ohlcv_cached(symbol: str, timeframe=TIMEFRAME):
+    """Свечи пары через общий кэш: одна загрузка базового таймфрейма до закрытия его бара,
+    старшие таймфреймы — ресемплинг из нее (тоже кэшируется)."""
+    ticker_symbol = PAIRS_TICKERS.get(symbol)
+    if not ticker_symbol:
+        return pd.DataFrame()
+
+    base = await ohlcv_cache.get_or_fetch(ohlcv_cache_key(symbol), lambda: fetch_shared_ohlcv(symbol), BASE_TIMEFRAME)
+    df = base
+    if timeframe != BASE_TIMEFRAME and not base.empty:
+        key = ohlcv_cache_key(symbol, timeframe)
+        df = ohlcv_cache.get(key)
+        if df is None:
+            df = await run_blocking(resample_ohlcv, base, timeframe, timeout=ANALYSIS_TIMEOUT)
+            # Формирующийся бар старшего таймфрейма меняется с каждым базовым баром
+            ohlcv_cache.put(key, df, next_bar_close(BASE_TIMEFRAME) + OHLCV_CACHE_GRACE)
+    # Кадр отдается без копии (колонки — memmap хранилища): инкрементальный движок его только читает
+    return df
+
+def _shared_ohlcv_key(symbol: str, timeframe=BASE_TIMEFRAME) -> str:
+    return 'ohlcv:' + ':'.join(ohlcv_cache_key(symbol, timeframe))
 
-# --- ИСПРАВЛЕННЫЕ ИМПОРТЫ AIOGRAM V3 ---
-from aiogram import Bot, Dispatcher, types 
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application 
-from aiohttp import web
-from aiogram.utils.text import escape_md, code, bold # <-- ИСПРАВЛЕНО
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+def encode_ohlcv(df: pd.DataFrame) -> bytes:
+    """Кадр для общего бэкенда — голые массивы, как в BarStore: ts (int64 нс UTC), затем BAR_COLUMNS (float64).
+    Без pickle: из бэкенда читаются только числа, а не объекты."""
+    index = df.index.tz_convert('UTC') if df.index.tz is not None else df.index.tz_localize('UTC')
+    arrays = [index.as_unit('ns').asi8.astype('<i8')] + [df[column].to_numpy(dtype='<f8') for column in BAR_COLUMNS]
+    return b''.join(array.tobytes() for array in arrays)
 
-# --- 1. КОНФИГУРАЦИЯ ---
+def decode_ohlcv(raw: bytes) -> pd.DataFrame:
+    """Обратное к encode_ohlcv (колонки — представления буфера, только чтение)."""
+    rows = len(raw) // (8 * (len(BAR_COLUMNS) + 1))
+    index = pd.DatetimeIndex(np.frombuffer(raw, dtype='<i8', count=rows).view('datetime64[ns]')).tz_localize('UTC')
+    columns = {
+        column: np.frombuffer(raw, dtype='<f8', count=rows, offset=8 * rows * (i + 1))
+        for i, column in enumerate(BAR_COLUMNS)
+    }
+    return pd.DataFrame(columns, index=index, copy=False)
 
-# Читаем переменные из окружения Render.
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-WEBHOOK_HOST = os.getenv('WEBHOOK_URL')  # URL твоего сервиса на Render (напр., https://mybot.onrender.com)
-WEBAPP_PORT = int(os.getenv('PORT', 10000)) # Порт, который слушает твой worker
+async def publish_ohlcv(symbol: str, df: pd.DataFrame, timeframe=BASE_TIMEFRAME):
+    """Кладет кадр в общий бэкенд до закрытия бара, чтобы другие воркеры не скачивали его заново."""
+    ttl = next_bar_close(timeframe) + OHLCV_CACHE_GRACE - time.time()
+    await state_backend.set(_shared_ohlcv_key(symbol, timeframe), encode_ohlcv(df), ttl=ttl)
 
-# Определяем путь и полный URL для вебхука
-WEBHOOK_PATH = f'/{TELEGRAM_TOKEN}'
-if WEBHOOK_HOST:
-    WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
-else:
-    WEBHOOK_URL = None
+async def fetch_shared_ohlcv(symbol: str, timeframe=BASE_TIMEFRAME):
+    """Промах локального кэша: сначала общий бэкенд, затем Yfinance."""
+    raw = await state_backend.get(_shared_ohlcv_key(symbol, timeframe))
+    if raw is not None:
+        return decode_ohlcv(raw)
 
-if not TELEGRAM_TOKEN:
-    print("❌ ОШИБКА: TELEGRAM_TOKEN не найден в переменных окружения. Бот не запустится.")
-    # Вместо exit(1) в асинхронном окружении, лучше просто завершить инициализацию
-    # Но для отладки оставим print. Запуск Webhooks ниже все равно не сработает без токена.
+    df = await get_ohlcv_async(symbol, timeframe)
+    if not df.empty:
+        await publish_ohlcv(symbol, df, timeframe)
+    return df
 
-# Настройка временной зоны (Москва/UTC+3)
-TIMEZONE = 'Europe/Moscow' 
-TZ = pytz.timezone(TIMEZONE)
+# --- ШАБЛОНЫ СООБЩЕНИЙ И КЛАВИАТУР ---
+# Постоянные части сообщений экранируются для MarkdownV2 один раз при импорте, и сообщение
+# собирается одним format(). Статичные клавиатуры тоже строятся один раз и общие для всех хендлеров.
 
-# Валютные пары и их тикеры для Yfinance
-PAIRS_TICKERS = {
-    "EUR/USD": "EURUSD=X", "GBP/USD": "GBPUSD=X", "USD/JPY": "USDJPY=X", 
-    "AUD/USD": "AUDUSD=X", "USD/CAD": "CAD=X", "USD/CHF": "CHF=X",
-    "EUR/JPY": "EURJPY=X", "GBP/JPY": "GBPJPY=X", "AUD/JPY": "AUDJPY=X", 
-    "EUR/GBP": "EURGBP=X", "EUR/AUD": "EURAUD=X", "GBP/AUD": "GBPAUD=X",
-    "CAD/JPY": "CADJPY=X", "CHF/JPY": CADJPY=X", "EUR/CAD": "EURCAD=X", 
-    "GBP/CAD": "GBPCAD=X", "AUD/CAD": "AUDCAD=X", "AUD/CHF": "AUDCHF=X", 
-    "CAD/CHF": "CADCHF=X"
-}
-PAIRS = list(PAIRS_TICKERS.keys())
+PAIR_LABELS = {pair: code(escape_md(pair)) for pair in PAIRS}
 
-TIMEFRAME = '1h' 
-LIMIT_DAYS = '7d' 
+def pair_label(symbol: str) -> str:
+    """Экранированное имя пары в `code`."""
+    return PAIR_LABELS.get(symbol) or code(escape_md(symbol))
 
-# Инициализация бота и диспетчера
-bot = Bot(token=TELEGRAM_TOKEN, parse_mode='MarkdownV2')
-dp = Dispatcher() # Диспетчер aiogram v3
+SIGNAL_TEMPLATE = f"""
+📈 {bold(escape_md("ТОРГОВЫЙ СИГНАЛ"))} \\| {{symbol}} \\({{timeframe}}\\) 
+*---*
+* {bold(escape_md("НАПРАВЛЕНИЕ"))}: {{direction}}
+* {bold(escape_md("Текущая Цена"))}: {{price}}
+* {bold(escape_md("УВЕРЕННОСТЬ"))}: {{confidence}}
+* {bold(escape_md("Экспирация"))}: {{expiration}}
+* {bold(escape_md("Обоснование"))}: {{reason}}
 
-# --- ВРЕМЕННОЕ ХРАНИЛИЩЕ ДЛЯ ИСТОРИИ ---
-user_history = {} 
+🔥 _Сигнал сформирован на основе анализа 15\\+ индикаторов\\._
+"""
+NEUTRAL_TEMPLATE = "⚠️ Для {symbol} нет сильного сигнала\\. {reason}"
+ALERT_HEADER = "🔔 " + bold(escape_md("АЛЕРТ ПО ПОДПИСКЕ")) + "\n"
+WELCOME_TEMPLATE = "👋 Привет, {name}! Я твой торговый помощник\\.\nВыбери нужную функцию:"
+NEXT_ACTION_TEXT = "Выбери следующую функцию:"
+NO_DATA_TEMPLATE = "❌ Не удалось получить достаточно данных для {symbol}\\. Попробуйте другой таймфрейм или пару\\."
+PROVIDERS_DOWN_TEMPLATE = "⏳ Источники котировок сейчас недоступны, данных по {symbol} нет\\. Попробуйте через минуту\\."
+RESULT_TEMPLATE = "📊 Сигнал для {symbol} зафиксирован:\\\n\n" + bold(escape_md('РЕЗУЛЬТАТ')) + ": {result}\\\n_Сохранено в Истории\\._"
+HISTORY_HEADER = "📜 " + bold(escape_md("ВАША ИСТОРИЯ СДЕЛОК")) + " 📜\n\n"
+HISTORY_LINE_TEMPLATE = (
+    "{n}\\. {icon} {result} \\| {symbol} \\({direction}\\) "
+    "Уверенность: {confidence}\n"
+    "_Время: {time}_\n\n"
+)
+STRENGTH_HEADER = "💪 " + bold(escape_md("СИЛА ВАЛЮТ")) + " \\({timeframe}, {window} баров\\)\n\n"
+STRENGTH_LINE_TEMPLATE = "{n}\\. {currency} {bar} {change}\n"
+CORRELATION_HEADER = "\n🔗 " + bold(escape_md("СИЛЬНЕЙШИЕ КОРРЕЛЯЦИИ")) + " \\({window} баров\\)\n"
+CORRELATION_LINE_TEMPLATE = "{first} ↔ {second}: {value}\n"
+NO_STRENGTH_TEXT = "❌ Не удалось получить достаточно данных для расчета силы валют\\. Попробуйте позже\\."
 
-# --- 2. ФУНКЦИИ АНАЛИЗА И ПРОВЕРКИ ---
+def _build_main_menu() -> InlineKeyboardMarkup:
+    menu = InlineKeyboardBuilder()
+    menu.button(text="📊 Валютные пары (Тех. Анализ)", callback_data='pairs')
+    menu.button(text="💪 Сила валют и корреляции", callback_data='strength')
+    menu.button(text="📰 Новости (Фундаментальный Анализ)", callback_data='news_analysis')
+    menu.button(text="📜 История Сделок", callback_data='history')
+    menu.adjust(1)
+    return menu.as_markup()
 
-def is_weekend():
-    """Проверяет, является ли текущий день субботой (5) или воскресеньем (6)."""
-    now = datetime.now(TZ)
-    return now.weekday() >= 5
+def _build_pairs_keyboard(timeframe: str) -> InlineKeyboardMarkup:
+    """Клавиатура пар с переключателем таймфрейма (выбранный отмечен)."""
+    pairs_menu = InlineKeyboardBuilder()
+    for pair in PAIRS:
+        cb_data = f'analyze_{pair.replace("/", "_")}'
+        if timeframe != TIMEFRAME:
+            cb_data += f':{timeframe}'
+        pairs_menu.button(text=pair, callback_data=cb_data)
+    pairs_menu.adjust(2)
 
-def get_ohlcv(symbol: str, timeframe=TIMEFRAME):
-    """Получение исторических данных OHLCV через Yfinance."""
-    ticker_symbol = PAIRS_TICKERS.get(symbol)
-    if not ticker_symbol:
-        return pd.DataFrame()
-        
-    try:
-        data = yf.download(
-            tickers=ticker_symbol, 
-            period=LIMIT_DAYS, 
-            interval=timeframe, 
-            auto_adjust=False, 
-            progress=False 
-        )
-        df = data.dropna()
-        df.columns = df.columns.str.lower()
-        df = df[['open', 'high', 'low', 'close', 'volume']]
-        return df
-    except Exception as e:
-        print(f"Ошибка получения данных Yfinance для {symbol}: {e}")
-        return pd.DataFrame()
+    pairs_menu.row(*(
+        InlineKeyboardButton(text=f"✅ {tf}" if tf == timeframe else tf, callback_data=f'pairs_tf_{tf}')
+        for tf in ANALYSIS_TIMEFRAMES
+    ))
+    pairs_menu.row(InlineKeyboardButton(text="🔔 Подписки на сигналы", callback_data='subs'))
+    pairs_menu.row(InlineKeyboardButton(text="⬅️ Назад", callback_data='main_menu'))
+    return pairs_menu.as_markup()
 
-def analyze_and_predict(df: pd.DataFrame, symbol: str):
-    """Основная функция технического анализа (15+ индикаторов)."""
+def _build_signal_button(symbol: str) -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardBuilder()
+    keyboard.button(text="📊 Взять сигнал", callback_data=f'analyze_{symbol.replace("/", "_")}')
+    return keyboard.as_markup()
+
+main_menu = _build_main_menu()
+PAIRS_KEYBOARDS = {tf: _build_pairs_keyboard(tf) for tf in dict.fromkeys(ANALYSIS_TIMEFRAMES + [TIMEFRAME])}
+SIGNAL_BUTTONS = {pair: _build_signal_button(pair) for pair in PAIRS}  # Кнопка под алертом подписки
+
+def pairs_keyboard(timeframe: str) -> InlineKeyboardMarkup:
+    return PAIRS_KEYBOARDS[timeframe]
+
+def result_keyboard(signal_id: str) -> InlineKeyboardMarkup:
+    """Кнопки фиксации результата и под ними главное меню (зависят от signal_id, поэтому сразу разметкой)."""
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ ПЛЮС (Прибыль)", callback_data=f'result_win_{signal_id}'),
+        InlineKeyboardButton(text="❌ МИНУС (Убыток)", callback_data=f'result_loss_{signal_id}'),
+    ], *main_menu.inline_keyboard])
+
+# --- ТАБЛИЦА СНИМКОВ СИГНАЛОВ ---
+# Сигнал одинаков для всех пользователей до закрытия бара, поэтому считаем его один раз на бар
+# и храним вместе с готовым (уже экранированным) текстом сообщения.
+
+signal_snapshots = {}  # (пара, таймфрейм) -> снимок сигнала (локальная копия; общая — в state_backend)
+
+def render_signal_message(signal: dict) -> str:
+    """Текст сообщения с сигналом в MarkdownV2."""
+    if signal['direction'] == NEUTRAL_DIRECTION:
+        return NEUTRAL_TEMPLATE.format(symbol=pair_label(signal['symbol']), reason=signal['reason'])
+
+    return SIGNAL_TEMPLATE.format(
+        symbol=pair_label(signal['symbol']),
+        timeframe=signal['timeframe'],
+        direction=signal['direction'],
+        price=code(signal['price']),
+        confidence=bold(signal['confidence']),
+        expiration=signal['expiration'],
+        reason=signal['reason'],
+    )
+
+def build_snapshot(df: pd.DataFrame, symbol: str, timeframe=TIMEFRAME, strength: dict = None):
+    """Считает сигнал по свечам и сохраняет снимок в таблицу. None, если данных мало.
+
+    strength — снимок силы валют того же таймфрейма (дополнительный вход балла, если STRENGTH_WEIGHT).
+    """
+    signal = analyze_incremental(df, symbol, timeframe, strength_gap(strength, symbol))
+    if signal is None:
+        return None
+
+    signal['text'] = render_signal_message(signal)
+    signal['bar'] = str(df.index[-1])
+    # Формирующийся бар любого таймфрейма меняется с каждым базовым баром
+    signal['expires_at'] = next_bar_close(BASE_TIMEFRAME) + OHLCV_CACHE_GRACE
+    signal_snapshots[(symbol, timeframe)] = signal
+    return signal
+
+async def publish_snapshot(snapshot: dict):
+    """Публикует снимок в общий бэкенд до его истечения."""
+    ttl = snapshot['expires_at'] - time.time()
+    if ttl > 0:
+        key = f"snapshot:{snapshot['symbol']}:{snapshot['timeframe']}"
+        await state_backend.set(key, json.dumps(snapshot).encode(), ttl=ttl)
+
+async def get_signal(symbol: str, timeframe=TIMEFRAME):
+    """Снимок сигнала для пары: из таблицы (локальной, затем общей), а если он устарел — пересчет по кэшу свечей.
+
+    None — если свечей слишком мало; DataProviderError — если свечи не отдал ни один поставщик.
+    """
+    snapshot = signal_snapshots.get((symbol, timeframe))
+    if snapshot is None or time.time() >= snapshot['expires_at']:
+        raw = await state_backend.get(f'snapshot:{symbol}:{timeframe}')
+        if raw is not None:
+            snapshot = signal_snapshots[(symbol, timeframe)] = json.loads(raw)
+    if snapshot is not None and time.time() < snapshot['expires_at']:
+        return snapshot
+
+    df = await get_ohlcv_cached(symbol, timeframe)
     if df.empty or len(df) < 50:
         return None
 
-    # Расчет индикаторов
-    df.ta.rsi(append=True)
-    df.ta.macd(append=True)
-    df.ta.sma(length=50, append=True) 
-    df.ta.ema(length=20, append=True)
-    df.ta.stoch(append=True) 
-    df.ta.adx(append=True) 
-    df.ta.bbands(append=True) 
-    df.ta.obv(append=True) 
-    df.ta.aop(append=True) 
-    df.ta.vwap(append=True)
-    
-    # Балльная система и логика определения сигнала
-    last = df.iloc[-1]
-    score = 0
-    if last['MACDh_12_26_9'] > 0: score += 2
-    if last['RSI_14'] < 30: score += 3 
-    if last['close'] > last['SMA_50']: score += 1
-    if last['STOCHk_14_3_3'] < 20 and last['STOCHd_14_3_3'] < 20: score += 2
-    if last['close'] < last['BBL_5_2.0']: score += 2
+    # Сила валют берется только из уже посчитанного снимка: лишних загрузок ради нее нет
+    strength = await lookup_strength(timeframe) if STRENGTH_WEIGHT else None
+    try:
+        snapshot = await run_blocking(build_snapshot, df, symbol, timeframe, strength, timeout=ANALYSIS_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"Таймаут анализа для {symbol} {timeframe} ({ANALYSIS_TIMEOUT} сек)")
+        return None
+    await publish_snapshot(snapshot)
+    return snapshot
 
-    # Определение направления
-    if score >= 6:
-        direction = "ВВЕРХ \\(BUY\\) 🚀"
-        reason = f"Сильный сигнал на покупку\\. {bold(escape_md('RSI, MACD и Stochastic'))} подтверждают восходящее движение\\."
-    elif score <= -6:
-        direction = "ВНИЗ \\(SELL\\) 👇"
-        reason = f"Сильный сигнал на продажу\\. {bold(escape_md('Индикаторы объемов и тренда'))} указывают на нисходящее движение\\."
-    elif score > 0:
-        direction = "ВВЕРХ \\(BUY\\) 📈"
-        reason = "Большинство индикаторов поддерживают рост\\."
-    elif score < 0:
-        direction = "ВНИЗ \\(SELL\\) 📉"
-        reason = "Большинство индикаторов поддерживают падение\\."
-    else:
-        direction = "НЕЙТРАЛЬНО ⚪"
-        reason = "Сигналы индикаторов противоречивы, риск слишком высок\\."
-        
-    confidence_base = 65.0
-    confidence = min(99.99, confidence_base + abs(score) * 3) 
-    expiration_time = "3 часа" if TIMEFRAME == '1h' else "6 часов"
+# --- СИЛА ВАЛЮТ И КОРРЕЛЯЦИИ ---
+# 19 пар делят 7 валют. Закрытия всех пар сводятся в одну матрицу (бары x пары), и за один проход
+# NumPy считает и силу каждой валюты, и корреляции доходностей пар. Результат одинаков для всех
+# пользователей, поэтому, как и сигнал, считается раз на бар и хранится снимком с готовым текстом.
+
+CURRENCIES = sorted({currency for pair in PAIRS for currency in pair.split('/')})
+TOP_CORRELATIONS = 5  # Сколько сильнейших корреляций показывать
+
+strength_snapshots = {}  # таймфрейм -> снимок силы валют (локальная копия; общая — в state_backend)
+strength_rebuilds = {}   # таймфрейм -> asyncio.Task текущего пересчета (single-flight)
+
+def _incidence_matrix(pairs: list):
+    """Матрица валюта x пара: +1 — базовая валюта пары, -1 — котируемая."""
+    incidence = np.zeros((len(CURRENCIES), len(pairs)))
+    for column, pair in enumerate(pairs):
+        base, quote = pair.split('/')
+        incidence[CURRENCIES.index(base), column] = 1
+        incidence[CURRENCIES.index(quote), column] = -1
+    return incidence
+
+@timed('stage_seconds', stage='strength')
+def compute_strength(frames: dict, timeframe=TIMEFRAME):
+    """Сила валют и корреляции пар по свечам одного таймфрейма. None, если пар или баров мало.
+
+    Сила валюты — среднее изменение (в %) за STRENGTH_WINDOW баров по всем парам с ней
+    (для котируемой валюты со знаком минус), z — она же в сигмах относительно остальных валют.
+    """
+    pairs = [pair for pair in PAIRS if pair in frames and not frames[pair].empty]
+    if len(pairs) < 2:
+        return None
+
+    # Выравнивание по времени: пропуски отдельных пар закрываем последним известным закрытием
+    closes = pd.concat({pair: frames[pair]['close'] for pair in pairs}, axis=1).sort_index().ffill().dropna()
+    if len(closes) <= STRENGTH_WINDOW or len(closes) < 3:
+        return None
+    log_close = np.log(closes.to_numpy(dtype=float))
+
+    incidence = _incidence_matrix(pairs)
+    counts = np.abs(incidence).sum(axis=1)
+    known = counts > 0
+    moves = log_close[-1] - log_close[-1 - STRENGTH_WINDOW]
+    change = (incidence @ moves)[known] / counts[known] * 100
+    spread = change.std()
+    z = (change - change.mean()) / spread if spread > 0 else np.zeros_like(change)
 
+    returns = np.diff(log_close[-(CORRELATION_WINDOW + 1):], axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized = (returns - returns.mean(axis=0)) / returns.std(axis=0)
+    normalized = np.nan_to_num(normalized)  # Пара без движения в окне — нулевая корреляция
+    correlation = normalized.T @ normalized / len(returns)
+
+    first, second = np.triu_indices(len(pairs), 1)  # Каждая пара пар — один раз, без диагонали
+    pair_corr = correlation[first, second]
+    top = np.argsort(-np.abs(pair_corr))[:TOP_CORRELATIONS]
+
+    currencies = [currency for currency, present in zip(CURRENCIES, known) if present]
     return {
-        'symbol': symbol,
-        'direction': direction,
-        'confidence': f"{confidence:.2f}\\%",
-        'expiration': expiration_time,
-        'reason': reason,
-        'price': f"{last['close']:.4f}",
+        'timeframe': timeframe,
+        'window': STRENGTH_WINDOW,
+        'correlation_window': len(returns),
+        'bar': str(closes.index[-1]),
+        'currencies': {
+            currency: {'change': round(float(c), 4), 'z': round(float(s), 3)}
+            for currency, c, s in zip(currencies, change, z)
+        },
+        'pairs': pairs,
+        'correlation': correlation.round(3).tolist(),
+        'top_correlations': [
+            (pairs[first[i]], pairs[second[i]], round(float(pair_corr[i]), 3)) for i in top
+        ],
     }
 
+def strength_gap(strength: dict, symbol: str):
+    """Перевес силы базовой валюты пары над котируемой, в сигмах. None, если снимка нет."""
+    if not strength:
+        return None
+    base, quote = symbol.split('/')
+    currencies = strength['currencies']
+    if base not in currencies or quote not in currencies:
+        return None
+    return round(currencies[base]['z'] - currencies[quote]['z'], 3)
+
+def render_strength_message(strength: dict) -> str:
+    """Текст рейтинга валют и сильнейших корреляций в MarkdownV2."""
+    lines = [STRENGTH_HEADER.format(timeframe=strength['timeframe'], window=strength['window'])]
+    ranking = sorted(strength['currencies'].items(), key=lambda item: item[1]['z'], reverse=True)
+    for n, (currency, value) in enumerate(ranking, 1):
+        blocks = max(1, min(8, round(abs(value['z']) * 3)))
+        lines.append(STRENGTH_LINE_TEMPLATE.format(
+            n=n,
+            currency=code(currency),
+            bar=("🟩" if value['z'] >= 0 else "🟥") * blocks,
+            change=escape_md(f"{value['change']:+.2f}%"),
+        ))
+    lines.append(CORRELATION_HEADER.format(window=strength['correlation_window']))
+    for first, second, value in strength['top_correlations']:
+        lines.append(CORRELATION_LINE_TEMPLATE.format(
+            first=pair_label(first), second=pair_label(second), value=code(f"{value:+.2f}"),
+        ))
+    return ''.join(lines)
+
+def build_strength(frames: dict, timeframe=TIMEFRAME):
+    """Считает силу валют по свечам всех пар и сохраняет снимок в таблицу. None, если данных мало."""
+    strength = compute_strength(frames, timeframe)
+    if strength is None:
+        return None
+
+    strength['text'] = render_strength_message(strength)
+    strength['expires_at'] = next_bar_close(BASE_TIMEFRAME) + OHLCV_CACHE_GRACE
+    strength_snapshots[timeframe] = strength
+    return strength
+
+async def publish_strength(strength: dict):
+    """Публикует снимок силы валют в общий бэкенд до его истечения."""
+    ttl = strength['expires_at'] - time.time()
+    if ttl > 0:
+        await state_backend.set(f"strength:{strength['timeframe']}", json.dumps(strength).encode(), ttl=ttl)
+
+async def lookup_strength(timeframe=TIMEFRAME):
+    """Действующий снимок силы валют из таблицы (локальной, затем общей) или None — без пересчета."""
+    strength = strength_snapshots.get(timeframe)
+    if strength is None or time.time() >= strength['expires_at']:
+        raw = await state_backend.get(f'strength:{timeframe}')
+        if raw is not None:
+            strength = strength_snapshots[timeframe] = json.loads(raw)
+    if strength is not None and time.time() < strength['expires_at']:
+        return strength
+    return None
+
+async def get_strength(timeframe=TIMEFRAME):
+    """Снимок силы валют: из таблицы, а если он устарел — пересчет по кэшу свечей всех пар."""
+    strength = await lookup_strength(timeframe)
+    if strength is not None:
+        return strength
+
+    # Одновременные запросы после закрытия бара ждут один общий пересчет, как в OHLCVCache
+    task = strength_rebuilds.get(timeframe)
+    if task is None:
+        task = strength_rebuilds[timeframe] = asyncio.ensure_future(_rebuild_strength(timeframe))
+        task.add_done_callback(lambda _: strength_rebuilds.pop(timeframe, None))
+    return await asyncio.shield(task)
+
+async def _rebuild_strength(timeframe: str):
+    """Пересчет снимка силы валют (вызывается из get_strength по одному на таймфрейм)."""
+    # Базовые свечи: из кэша, затем из общего бэкенда, а недостающие — одним пакетным запросом, как в прогреве
+    bases = {pair: ohlcv_cache.get(ohlcv_cache_key(pair)) for pair in PAIRS}
+    for pair in [pair for pair, df in bases.items() if df is None]:
+        raw = await state_backend.get(_shared_ohlcv_key(pair))
+        if raw is not None:
+            bases[pair] = decode_ohlcv(raw)
+    missing = [pair for pair, df in bases.items() if df is None]
+    if missing:
+        try:
+            fetched = await run_blocking(get_ohlcv_batch, missing, BASE_TIMEFRAME, timeout=FETCH_TIMEOUT * 2)
+        except (asyncio.TimeoutError, DataProviderError) as e:
+            print(f"⚠️ Сила валют без {len(missing)} пар: {str(e) or 'таймаут загрузки'}")
+            fetched = {}
+        expires_at = next_bar_close(BASE_TIMEFRAME) + OHLCV_CACHE_GRACE
+        for pair, df in fetched.items():
+            if not df.empty:
+                ohlcv_cache.put(ohlcv_cache_key(pair), df, expires_at)
+                await publish_ohlcv(pair, df)
+        bases.update(fetched)
+
+    def build():
+        frames = {pair: resample_ohlcv(df, timeframe) for pair, df in bases.items() if df is not None and not df.empty}
+        return build_strength(frames, timeframe)
+
+    try:
+        strength = await run_blocking(build, timeout=ANALYSIS_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"Таймаут расчета силы валют {timeframe} ({ANALYSIS_TIMEOUT} сек)")
+        return None
+    if strength is not None:
+        await publish_strength(strength)
+    return strength
+
+# --- ФОНОВЫЙ ПРОГРЕВ ДАННЫХ ---
+
+async def prewarm_ohlcv():
+    """Загружает базовый таймфрейм всех пар одним запросом и раскладывает его по кэшу."""
+    started = time.perf_counter()
+    try:
+        frames = await run_blocking(get_ohlcv_batch, PAIRS, BASE_TIMEFRAME, timeout=FETCH_TIMEOUT * 2)
+    except asyncio.TimeoutError:
+        print(f"Таймаут пакетной загрузки Yfinance ({FETCH_TIMEOUT * 2} сек)")
+        return
+
+    expires_at = next_bar_close(BASE_TIMEFRAME) + OHLCV_CACHE_GRACE
+    for symbol, df in frames.items():
+        if not df.empty:
+            ohlcv_cache.put(ohlcv_cache_key(symbol), df, expires_at)
+            await publish_ohlcv(symbol, df)
+
+    # Досчитываем индикаторы и снимки сигналов по всем таймфреймам сразу, чтобы запрос пользователя их уже не считал
+    resampled, snapshots, strengths, alerts = await run_blocking(_build_snapshots, frames, timeout=ANALYSIS_TIMEOUT)
+    for key, df in resampled.items():
+        ohlcv_cache.put(key, df, expires_at)
+    for strength in strengths:
+        await publish_strength(strength)
+    for snapshot in snapshots:
+        await publish_snapshot(snapshot)
+    # Алерты подписчикам — только по закрытым барам таймфрейма по умолчанию
+    await notify_subscribers(alerts)
+    print(f"🔥 Прогрев: {len(frames)}/{len(PAIRS)} пар x {len(ANALYSIS_TIMEFRAMES)} ТФ за {time.perf_counter() - started:.1f} сек")
+
+def _build_snapshots(frames: dict):
+    """Ресемплинг базовых свечей в таймфреймы анализа, сила валют и снимки сигналов по каждому,
+    а для TIMEFRAME — еще и сигналы по последнему закрытому бару (для алертов)."""
+    resampled, snapshots, strengths, alerts = {}, [], [], []
+    frames = {symbol: base for symbol, base in frames.items() if not base.empty}
+    for timeframe in ANALYSIS_TIMEFRAMES:
+        tf_frames = {symbol: resample_ohlcv(base, timeframe) for symbol, base in frames.items()}
+        if timeframe != BASE_TIMEFRAME:
+            resampled.update((ohlcv_cache_key(symbol, timeframe), df) for symbol, df in tf_frames.items())
+        # Сила валют — до сигналов: она входит в балл каждой пары
+        strength = build_strength(tf_frames, timeframe)
+        if strength is not None:
+            strengths.append(strength)
+        for symbol, df in tf_frames.items():
+            snapshot = build_snapshot(df, symbol, timeframe, strength) if len(df) >= 50 else None
+            if snapshot is not None:
+                snapshots.append(snapshot)
+            alert = closed_bar_signal(df, symbol, timeframe, strength) if timeframe == TIMEFRAME else None
+            if alert is not None:
+                alerts.append(alert)
+    return resampled, snapshots, strengths, alerts
+
+def closed_bar_signal(df: pd.DataFrame, symbol: str, timeframe=TIMEFRAME, strength: dict = None):
+    """Сигнал по последнему закрытому бару таймфрейма (без формирующегося). None, если данных мало.
+
+    Прогрев идет на каждом базовом баре, а закрытый бар старшего таймфрейма меняется реже —
+    его индикаторы берутся из кэша движка, пока не закроется следующий.
+    """
+    closed = df[df.index + pd.Timedelta(seconds=TIMEFRAME_SECONDS[timeframe]) <= pd.Timestamp.now(tz='UTC')]
+    if len(closed) < 50:
+        return None
+    values = indicator_engine.update((symbol, timeframe, 'closed'), closed)
+    signal = score_signal(values, symbol, timeframe, strength_gap(strength, symbol))
+    signal['text'] = render_signal_message(signal)
+    signal['bar'] = str(closed.index[-1])
+    return signal
+
+async def notify_subscribers(snapshots: list):
+    """Рассылает алерт подписчикам пар, у которых балл закрытого бара пересек SUBSCRIPTION_THRESHOLD.
+
+    Каждый закрытый бар проверяется один раз, сколько бы прогревов ни прошло до следующего.
+    """
+    for snapshot in snapshots:
+        symbol = snapshot['symbol']
+        # Бар и балл прошлой проверки хранятся в общем бэкенде: прогрев может делать любой воркер
+        previous = await state_backend.get(f'alert_score:{symbol}')
+        previous_bar, _, previous_score = previous.decode().rpartition('|') if previous is not None else ('', '', '')
+        if previous_bar == snapshot['bar']:
+            continue
+        await state_backend.set(f'alert_score:{symbol}', f"{snapshot['bar']}|{snapshot['score']}".encode())
+        # Первая проверка только запоминает балл, чтобы не рассылать алерты повторно после рестарта
+        if not previous_score or not (abs(int(previous_score)) < SUBSCRIPTION_THRESHOLD <= abs(snapshot['score'])):
+            continue
+
+        subscribers = await subscription_store.subscribers(symbol)
+        if not subscribers:
+            continue
+        text = ALERT_HEADER + snapshot['text']
+        for user_id in subscribers:
+            send_queue.send(user_id, text, reply_markup=SIGNAL_BUTTONS[symbol])
+        print(f"🔔 Алерт {symbol} (балл {snapshot['score']}): {len(subscribers)} подписчиков")
+
+async def prewarm_scheduler():
+    """Фоновая задача: прогрев сразу при старте и затем после закрытия каждого бара.
+
+    При нескольких воркерах прогрев на каждом баре делает тот, кто первым взял блокировку этого бара.
+    """
+    while True:
+        bar_lock = f'lock:prewarm:{int(next_bar_close(BASE_TIMEFRAME))}'
+        if not is_weekend() and await state_backend.set_nx(bar_lock, str(os.getpid()).encode(), ttl=TIMEFRAME_SECONDS[BASE_TIMEFRAME]):
+            try:
+                await prewarm_ohlcv()
+            except Exception as e:
+                print(f"❌ Ошибка прогрева данных: {e}")
+        await asyncio.sleep(next_bar_close(BASE_TIMEFRAME) + PREWARM_DELAY - time.time())
+
 def analyze_news(symbol: str):
     """Заглушка для функции анализа новостей."""
     direction = bold(escape_md("ВНИЗ (SELL)")) + " 🔴"
@@ -163,40 +2417,83 @@ def analyze_news(symbol: str):
 
 # --- 3. ОБРАБОТЧИКИ (Telegram) ---
 
-# Главное меню (кнопки)
-main_menu = InlineKeyboardMarkup(row_width=1)
-main_menu.add(
-    InlineKeyboardButton("📊 Валютные пары (Тех. Анализ)", callback_data='pairs'),
-    InlineKeyboardButton("📰 Новости (Фундаментальный Анализ)", callback_data='news_analysis'),
-    InlineKeyboardButton("📜 История Сделок", callback_data='history')
-)
+# Главное меню, клавиатуры пар и кнопки результата собираются в секции шаблонов
 
-# Кнопки для фиксации результата
-def result_keyboard(signal_id):
-    kb = InlineKeyboardMarkup(row_width=2)
-    kb.add(
-        InlineKeyboardButton("✅ ПЛЮС (Прибыль)", callback_data=f'result_win_{signal_id}'),
-        InlineKeyboardButton("❌ МИНУС (Убыток)", callback_data=f'result_loss_{signal_id}')
-    )
-    return kb
+# Все ответы идут через send_queue (общий лимит и повтор на 429). На нажатие кнопки отвечаем
+# одним сообщением: результат и главное меню вместе, а сообщение с кнопкой правим на месте.
+
+# Без фоновой обработки вебхука (WEBHOOK_BACKGROUND=0) ответ на нажатие кнопки уходит телом HTTP-ответа
+# на апдейт, а не отдельным вызовом Bot API: на действие остается один вызов — само сообщение.
+# Цена — ответ приходит только после хендлера, поэтому тост о ходе работы там бессмыслен и не отправляется.
+_webhook_answer = contextvars.ContextVar('webhook_answer', default=None)
+
+async def webhook_answer_middleware(handler, event, data):
+    """Middleware aiogram: отложенный ответ на нажатие (см. answer()) становится результатом хендлера."""
+    box = []
+    token = _webhook_answer.set(box)
+    try:
+        result = await handler(event, data)
+    finally:
+        _webhook_answer.reset(token)
+    return box[0] if box and result is None else result
+
+dp.callback_query.middleware(webhook_answer_middleware)
+
+async def answer(callback_query: types.CallbackQuery, text: str = None, show_alert: bool = False, progress: bool = False):
+    """Ответ на нажатие кнопки: в теле ответа вебхука, если он ждет хендлер, иначе — вызовом Bot API.
+    progress — текст о ходе долгой операции («Анализирую...»), в ответе вебхука он опоздал бы и опускается."""
+    box = _webhook_answer.get()
+    if not WEBHOOK_BACKGROUND and box is not None and not box:
+        box.append(AnswerCallbackQuery(
+            callback_query_id=callback_query.id, text=None if progress else text, show_alert=show_alert
+        ))
+        return
+    await bot.answer_callback_query(callback_query.id, text=text, show_alert=show_alert)
+
+async def reply(callback_query: types.CallbackQuery, text: str, reply_markup: InlineKeyboardMarkup = None):
+    """Показывает ответ на нажатие кнопки одним вызовом API: правит сообщение с кнопкой,
+    а если это невозможно (сообщение старое или не текстовое) — отправляет новое."""
+    message = callback_query.message
+    if message is not None:
+        try:
+            return await send_queue.call(
+                'edit_message_text', message.chat.id,
+                message_id=message.message_id, text=text, reply_markup=reply_markup
+            )
+        except TelegramBadRequest as e:
+            if 'message is not modified' in str(e):
+                return None
+    return await send_queue.call('send_message', callback_query.from_user.id, text=text, reply_markup=reply_markup)
+
+async def edit_markup(callback_query: types.CallbackQuery, reply_markup: InlineKeyboardMarkup):
+    """Обновляет только клавиатуру сообщения с кнопкой."""
+    try:
+        await send_queue.call(
+            'edit_message_reply_markup', callback_query.message.chat.id,
+            message_id=callback_query.message.message_id, reply_markup=reply_markup
+        )
+    except TelegramBadRequest as e:
+        if 'message is not modified' not in str(e):
+            raise
 
 # Функция-блокиратор для выходных дней
 async def weekend_blocker_message(user_id):
-    await bot.send_message(
+    send_queue.send(
         user_id,
         "Ты дебил иди отдыхай я тоже отдыхаю после того как тебе давал сигнал я тоже устал 😅",
         parse_mode='MarkdownV2'
     )
 
-@dp.message(commands=['start', 'help'])
+@dp.message(Command('start', 'help'))
 async def send_welcome(message: types.Message): # Исправлено для aiogram v3
     """Обработчик команды /start."""
     if is_weekend():
         await weekend_blocker_message(message.from_user.id)
         return
         
-    await message.answer( # message.answer() вместо message.reply() для aiogram v3
-        f"👋 Привет, {escape_md(message.from_user.first_name)}! Я твой торговый помощник\\.\nВыбери нужную функцию:",
+    await send_queue.call(
+        'send_message', message.chat.id,
+        text=WELCOME_TEMPLATE.format(name=escape_md(message.from_user.first_name)),
         reply_markup=main_menu
     )
 
@@ -204,216 +2501,289 @@ async def send_welcome(message: types.Message): # Исправлено для ai
 async def show_pairs_menu(callback_query: types.CallbackQuery): # Исправлено для aiogram v3
     """Меню выбора валютных пар."""
     if is_weekend():
-        await bot.answer_callback_query(callback_query.id, text="Я отдыхаю\\!", show_alert=True)
+        await answer(callback_query, text="Я отдыхаю\\!", show_alert=True)
         await weekend_blocker_message(callback_query.from_user.id)
         return
 
-    await bot.answer_callback_query(callback_query.id)
-    pairs_menu = InlineKeyboardMarkup(row_width=2)
-    
+    await answer(callback_query)
+    await reply(callback_query, "Выберите таймфрейм и валютную пару для Технического Анализа:", pairs_keyboard(TIMEFRAME))
+
+@dp.callback_query(lambda c: c.data.startswith('pairs_tf_'))
+async def switch_timeframe(callback_query: types.CallbackQuery):
+    """Переключение таймфрейма в меню пар (клавиатура обновляется на месте)."""
+    timeframe = callback_query.data[len('pairs_tf_'):]
+    await answer(callback_query)
+    if timeframe not in ANALYSIS_TIMEFRAMES:
+        return
+    await edit_markup(callback_query, pairs_keyboard(timeframe))
+
+async def subscriptions_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    """Клавиатура подписок: отмеченные пары — те, на которые пользователь подписан."""
+    subscribed = await subscription_store.pairs_for(user_id)
+    keyboard = InlineKeyboardBuilder()
     for pair in PAIRS:
-        cb_data = f'analyze_{pair.replace("/", "_")}' 
-        pairs_menu.insert(InlineKeyboardButton(pair, callback_data=cb_data))
-        
-    pairs_menu.row(InlineKeyboardButton("⬅️ Назад", callback_data='main_menu'))
-    
-    await bot.send_message(
-        callback_query.from_user.id,
-        "Выберите валютную пару для Технического Анализа:",
-        reply_markup=pairs_menu
+        mark = "✅ " if pair in subscribed else ""
+        keyboard.button(text=f"{mark}{pair}", callback_data=f'sub_{pair.replace("/", "_")}')
+    keyboard.adjust(2)
+    keyboard.row(InlineKeyboardButton(text="⬅️ Назад", callback_data='pairs'))
+    return keyboard.as_markup()
+
+@dp.callback_query(lambda c: c.data == 'subs')
+async def show_subscriptions(callback_query: types.CallbackQuery):
+    """Меню подписок на алерты по парам."""
+    await answer(callback_query)
+    await reply(
+        callback_query,
+        f"🔔 Отметьте пары: когда балл сигнала достигнет {SUBSCRIPTION_THRESHOLD}, я пришлю алерт\\.",
+        await subscriptions_keyboard(callback_query.from_user.id)
+    )
+
+@dp.callback_query(lambda c: c.data.startswith('sub_'))
+async def toggle_subscription(callback_query: types.CallbackQuery):
+    """Подписка/отписка на пару (клавиатура обновляется на месте)."""
+    symbol = callback_query.data.split('_', 1)[1].replace('_', '/')
+    if symbol not in PAIRS_TICKERS:
+        await answer(callback_query)
+        return
+
+    subscribed = await subscription_store.toggle(callback_query.from_user.id, symbol)
+    await answer(
+        callback_query, text=f"{'Подписка оформлена' if subscribed else 'Подписка отменена'}: {symbol}"
     )
+    await edit_markup(callback_query, await subscriptions_keyboard(callback_query.from_user.id))
 
 @dp.callback_query(lambda c: c.data.startswith('analyze_'))
 async def run_analysis(callback_query: types.CallbackQuery): # Исправлено для aiogram v3
     """Запуск анализа выбранной пары."""
     if is_weekend():
-        await bot.answer_callback_query(callback_query.id, text="Я отдыхаю\\!", show_alert=True)
+        await answer(callback_query, text="Я отдыхаю\\!", show_alert=True)
         await weekend_blocker_message(callback_query.from_user.id)
         return
         
-    await bot.answer_callback_query(callback_query.id, text="Провожу глубокий Тех\\. Анализ...", show_alert=False)
+    await answer(callback_query, text="Провожу глубокий Тех\\. Анализ...", progress=True)
     
-    symbol_raw = callback_query.data.split('_', 1)[1]
+    # analyze_EUR_USD — таймфрейм по умолчанию, analyze_EUR_USD:4h — выбранный в меню
+    symbol_raw, _, timeframe = callback_query.data.split('_', 1)[1].partition(':')
     symbol = symbol_raw.replace('_', '/')
+    if timeframe not in ANALYSIS_TIMEFRAMES:
+        timeframe = TIMEFRAME
     
-    df = get_ohlcv(symbol, TIMEFRAME)
+    try:
+        signal = await get_signal(symbol, timeframe)
+    except DataProviderError as e:
+        print(f"❌ Нет свечей {symbol} {timeframe}: {e}")
+        await reply(callback_query, PROVIDERS_DOWN_TEMPLATE.format(symbol=pair_label(symbol)), main_menu)
+        return
     
-    if df.empty or len(df) < 50:
-        await bot.send_message(
-            callback_query.from_user.id,
-            f"❌ Не удалось получить достаточно данных для {code(escape_md(symbol))}\\. Попробуйте другой таймфрейм или пару\\.",
-        )
-        await bot.send_message(
-            callback_query.from_user.id,
-            "Выбери следующую функцию:",
-            reply_markup=main_menu
-        )
+    if signal is None:
+        await reply(callback_query, NO_DATA_TEMPLATE.format(symbol=pair_label(symbol)), main_menu)
         return
-
-    signal = analyze_and_predict(df, symbol)
     
-    if signal and signal['direction'] != 'НЕЙТРАЛЬНО ⚪':
+    if signal['direction'] != NEUTRAL_DIRECTION:
         signal_id = str(hash(signal['symbol'] + signal['direction'] + str(datetime.now(TZ))))
         
-        message_text = f"""
-📈 {bold(escape_md("ТОРГОВЫЙ СИГНАЛ"))} \\| {code(escape_md(signal['symbol']))} \\({TIMEFRAME}\\) 
-*---*
-* {bold(escape_md("НАПРАВЛЕНИЕ"))}: {signal['direction']}
-* {bold(escape_md("Текущая Цена"))}: {code(signal['price'])}
-* {bold(escape_md("УВЕРЕННОСТЬ"))}: {bold(signal['confidence'])}
-* {bold(escape_md("Экспирация"))}: {signal['expiration']}
-* {bold(escape_md("Обоснование"))}: {signal['reason']}
-
-🔥 _Сигнал сформирован на основе анализа 15\\+ индикаторов\\._
-"""
-        user_history[signal_id] = {
+        await history_store.add(signal_id, {
             'user_id': callback_query.from_user.id,
             'symbol': signal['symbol'],
             'direction': signal['direction'],
             'confidence': signal['confidence'],
             'timestamp': datetime.now(TZ),
             'result': 'Pending'
-        }
+        })
         
-        await bot.send_message(
-            callback_query.from_user.id,
-            message_text,
-            reply_markup=result_keyboard(signal_id)
-        )
+        await reply(callback_query, signal['text'], result_keyboard(signal_id))
     else:
-        await bot.send_message(
-            callback_query.from_user.id,
-            f"⚠️ Для {code(escape_md(symbol))} нет сильного сигнала\\. {signal['reason']}" if signal else "⚠️ Анализ не дал результата\\.",
-        )
-        
-    await bot.send_message(
-        callback_query.from_user.id,
-        "Выбери следующую функцию:",
-        reply_markup=main_menu
-    )
+        await reply(callback_query, signal['text'], main_menu)
+
+@dp.callback_query(lambda c: c.data == 'strength')
+async def show_strength(callback_query: types.CallbackQuery):
+    """Рейтинг силы валют и сильнейшие корреляции пар (один снимок на бар для всех)."""
+    if is_weekend():
+        await answer(callback_query, text="Я отдыхаю\\!", show_alert=True)
+        await weekend_blocker_message(callback_query.from_user.id)
+        return
+
+    await answer(callback_query, text="Сравниваю валюты...", progress=True)
+    strength = await get_strength(TIMEFRAME)
+    await reply(callback_query, strength['text'] if strength else NO_STRENGTH_TEXT, main_menu)
 
 @dp.callback_query(lambda c: c.data == 'news_analysis')
 async def handle_news_analysis(callback_query: types.CallbackQuery): # Исправлено для aiogram v3
     """Обработчик кнопки Новостей."""
     if is_weekend():
-        await bot.answer_callback_query(callback_query.id, text="Я отдыхаю\\!", show_alert=True)
+        await answer(callback_query, text="Я отдыхаю\\!", show_alert=True)
         await weekend_blocker_message(callback_query.from_user.id)
         return
         
-    await bot.answer_callback_query(callback_query.id, text="Анализирую главные новости...", show_alert=False)
+    await answer(callback_query, text="Анализирую главные новости...", progress=True)
     
     news_symbol = 'EUR/USD' 
     news_report = analyze_news(news_symbol)
     
-    await bot.send_message(
-        callback_query.from_user.id,
-        news_report,
-    )
-    
-    await bot.send_message(
-        callback_query.from_user.id,
-        "Выбери следующую функцию:",
-        reply_markup=main_menu
-    )
+    await reply(callback_query, news_report, main_menu)
 
 @dp.callback_query(lambda c: c.data.startswith('result_'))
 async def handle_result_fix(callback_query: types.CallbackQuery): # Исправлено для aiogram v3
     """Фиксация результата сделки (Плюс/Минус)."""
     if is_weekend():
-        await bot.answer_callback_query(callback_query.id, text="Я отдыхаю\\!", show_alert=True)
+        await answer(callback_query, text="Я отдыхаю\\!", show_alert=True)
         await weekend_blocker_message(callback_query.from_user.id)
         return
         
-    await bot.answer_callback_query(callback_query.id)
-    
     parts = callback_query.data.split('_')
     result_type = parts[1] 
     signal_id = parts[2]
     
-    if signal_id in user_history:
-        history_entry = user_history[signal_id]
-        
-        if history_entry['result'] == 'Pending':
-            history_entry['result'] = 'WIN' if result_type == 'win' else 'LOSS'
-            
-            result_text = "✅ ПРИБЫЛЬ" if result_type == 'win' else "❌ УБЫТОК"
-            
-            await bot.edit_message_text(
-                f"📊 Сигнал для {code(escape_md(history_entry['symbol']))} зафиксирован:\\\n\n{bold(escape_md('РЕЗУЛЬТАТ'))}: {result_text}\\\n_Сохранено в Истории\\._",
-                chat_id=callback_query.message.chat.id,
-                message_id=callback_query.message.message_id,
-                reply_markup=None 
-            )
-        else:
-            await bot.send_message(callback_query.from_user.id, "Этот результат уже был зафиксирован\\.")
-    else:
-        await bot.send_message(callback_query.from_user.id, "Ошибка: Сигнал не найден\\.")
+    history_entry = await history_store.get(signal_id)
+    
+    # Ошибки показываем во всплывающем ответе на нажатие, без отдельного сообщения
+    if history_entry is None:
+        await answer(callback_query, text="Ошибка: Сигнал не найден.", show_alert=True)
+        return
+    if not await history_store.set_result(signal_id, 'WIN' if result_type == 'win' else 'LOSS'):
+        await answer(callback_query, text="Этот результат уже был зафиксирован.", show_alert=True)
+        return
+
+    await answer(callback_query)
+    result_text = "✅ ПРИБЫЛЬ" if result_type == 'win' else "❌ УБЫТОК"
+    await reply(
+        callback_query,
+        RESULT_TEMPLATE.format(symbol=pair_label(history_entry['symbol']), result=result_text),
+        main_menu
+    )
 
 @dp.callback_query(lambda c: c.data == 'history')
 async def show_history(callback_query: types.CallbackQuery): # Исправлено для aiogram v3
     """Показать историю сделок."""
     if is_weekend():
-        await bot.answer_callback_query(callback_query.id, text="Я отдыхаю\\!", show_alert=True)
+        await answer(callback_query, text="Я отдыхаю\\!", show_alert=True)
         await weekend_blocker_message(callback_query.from_user.id)
         return
         
-    await bot.answer_callback_query(callback_query.id)
+    await answer(callback_query)
     
     user_id = callback_query.from_user.id
-    history_list = [h for h in user_history.values() if h['user_id'] == user_id]
+    history_list = await history_store.recent(user_id, limit=10)
     
     if not history_list:
-        await bot.send_message(user_id, "📜 Ваша история сделок пока пуста\\.")
+        await reply(callback_query, "📜 Ваша история сделок пока пуста\\.", main_menu)
         return
 
-    history_text = "📜 " + bold(escape_md("ВАША ИСТОРИЯ СДЕЛОК")) + " 📜\n\n"
-    
-    for i, entry in enumerate(reversed(history_list[:10])): 
+    lines = [HISTORY_HEADER]
+    for i, entry in enumerate(history_list): 
         result_icon = "🟢" if entry['result'] == 'WIN' else "🔴" if entry['result'] == 'LOSS' else "🟡"
-        
-        history_text += (
-            f"{i+1}\\. {result_icon} {bold(entry['result'])} \\| {code(escape_md(entry['symbol']))} \\({entry['direction']}\\) "
-            f"Уверенность: {entry['confidence']}\n"
-            f"_Время: {entry['timestamp'].strftime('%d\\.%m %H:%M')}_\n\n"
-        )
-    
-    await bot.send_message(user_id, history_text)
+        lines.append(HISTORY_LINE_TEMPLATE.format(
+            n=i + 1,
+            icon=result_icon,
+            result=bold(entry['result']),
+            symbol=pair_label(entry['symbol']),
+            direction=entry['direction'],
+            confidence=entry['confidence'],
+            time=entry['timestamp'].strftime('%d\\.%m %H:%M'),
+        ))
+    history_text = ''.join(lines)
     
-    await bot.send_message(
-        user_id,
-        "Выбери следующую функцию:",
-        reply_markup=main_menu
-    )
+    await reply(callback_query, history_text, main_menu)
     
 @dp.callback_query(lambda c: c.data == 'main_menu')
 async def back_to_main_menu(callback_query: types.CallbackQuery): # Исправлено для aiogram v3
     """Возврат в главное меню."""
     if is_weekend():
-        await bot.answer_callback_query(callback_query.id, text="Я отдыхаю\\!", show_alert=True)
+        await answer(callback_query, text="Я отдыхаю\\!", show_alert=True)
         await weekend_blocker_message(callback_query.from_user.id)
         return
         
-    await bot.answer_callback_query(callback_query.id)
-    await bot.send_message(
-        callback_query.from_user.id,
-        "Выбери следующую функцию:",
-        reply_markup=main_menu
-    )
+    await answer(callback_query)
+    await reply(callback_query, NEXT_ACTION_TEXT, main_menu)
 
 # --- 4. ЗАПУСК (РЕЖИМ WEBHOOK AIOGRAM V3) ---
 
 WEBAPP_HOST = '0.0.0.0' # Слушаем все интерфейсы
 
+def register_gauges():
+    """Гейджи состояния: кэш, очереди, снимки, лаг event loop."""
+    metrics.gauge('ohlcv_cache_entries', "Записей в кэше свечей", lambda: len(ohlcv_cache))
+    metrics.gauge('ohlcv_cache_events_total', "События кэша свечей", lambda: dict(ohlcv_cache.stats), label='event', kind='counter')
+    metrics.gauge('signal_snapshots', "Пар со снимком сигнала", lambda: len(signal_snapshots))
+    metrics.gauge('analysis_queue_depth', "Задач в очереди пула анализа", lambda: analysis_executor._work_queue.qsize())
+    metrics.gauge('send_queue_depth', "Сообщений в очереди рассылки", send_queue.qsize)
+    metrics.gauge('history_pending_writes', "Записей истории, ждущих пакетной записи", history_store.pending_writes)
+    metrics.gauge('event_loop_lag_last_seconds', "Последний замер лага event loop", lambda: loop_lag['last'])
+    metrics.gauge('provider_up', "Поставщик свечей доступен (предохранитель не разомкнут)",
+                  lambda: {name: int(h.state != 'open') for name, h in provider_chain.health.items()}, label='provider')
+    metrics.gauge('startup_seconds', "Длительность этапов холодного старта", lambda: dict(startup_timings), label='stage')
+
+register_gauges()
+
+def _authorized(request: web.Request, token_required: bool = False) -> bool:
+    """Проверка ?token=. token_required — без METRICS_TOKEN эндпоинт недоступен никому."""
+    if not METRICS_TOKEN:
+        return not token_required
+    return hmac.compare_digest(request.query.get('token', ''), METRICS_TOKEN)
+
+async def metrics_handler(request: web.Request):
+    """GET /metrics — метрики в текстовом формате Prometheus."""
+    if not _authorized(request):
+        raise web.HTTPForbidden()
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+profile_lock = asyncio.Lock()
+
+async def profile_handler(request: web.Request):
+    """GET /debug/profile?seconds=N — сэмплирующий профайлер, ответ в формате collapsed stacks (flamegraph/speedscope)."""
+    # Стеки и поток-сэмплер на публичном хосте — только по токену
+    if not _authorized(request, token_required=True):
+        raise web.HTTPForbidden()
+    if profile_lock.locked():
+        raise web.HTTPConflict(text="Профилирование уже запущено")
+
+    try:
+        seconds = min(float(request.query.get('seconds', 10)), PROFILE_MAX_SECONDS)
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds должен быть числом")
+
+    async with profile_lock:
+        # Сэмплер работает в отдельном потоке, event loop в это время продолжает обслуживать апдейты
+        samples = await asyncio.get_running_loop().run_in_executor(None, sample_stacks, seconds)
+    body = '\n'.join(f"{stack} {count}" for stack, count in samples.most_common())
+    return web.Response(text=body + '\n', content_type='text/plain', charset='utf-8')
+
 async def on_startup(app: web.Application): # Изменен синтаксис для aiohttp
-    """Действия при запуске: устанавливаем вебхук на серверах Telegram."""
-    
-    # Получаем объект бота из приложения
-    bot = app['bot']
+    """Действия до bind: только быстрые хранилища и очереди (вебхук — в after_bind)."""
+    await history_store.start()
+    await subscription_store.start()
+    send_queue.start()
+    app['loop_lag_task'] = asyncio.create_task(monitor_loop_lag())
+
+async def after_bind(app: web.Application):
+    """Все, что может подождать, пока сервер уже слушает порт: вебхук, импорт аналитики, прогрев."""
+    await set_webhook(app['bot'])
+    mark_startup('webhook')
+    print("⏱ Старт: " + ", ".join(f"{stage} {seconds:.2f} с" for stage, seconds in startup_timings.items()))
 
+    if ANALYTICS_PREIMPORT:
+        started = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, preimport_analytics)
+            print(f"⏱ Аналитика загружена в фоне за {time.perf_counter() - started:.2f} с")
+        except Exception as e:
+            # Задача фоновая: без перехвата ошибка пропала бы молча вместе с прогревом.
+            # Импорт повторится при первом обращении к pd/yf, и там ошибка дойдет до пользователя
+            print(f"❌ Ошибка фонового импорта аналитики: {e!r}")
+
+    if PREWARM_ENABLED:
+        await prewarm_scheduler()
+
+async def set_webhook(bot: Bot):
+    """Устанавливаем вебхук на серверах Telegram."""
     if not WEBHOOK_URL:
         print("❌ ОШИБКА: Переменная WEBHOOK_URL не найдена. Не могу установить вебхук.")
         return # Не вызываем exit(1) в асинхронной функции, просто завершаем
 
+    # При нескольких воркерах вебхук ставит один из них
+    if not await state_backend.set_nx('lock:set_webhook', str(os.getpid()).encode(), ttl=60):
+        return
+
     print("Приложение запущено. Устанавливаю вебхук...")
     try:
         # Устанавливаем вебхук.
@@ -428,48 +2798,121 @@ async def on_shutdown(app: web.Application): # Изменен синтаксис
     
     # Получаем объект бота из приложения
     bot = app['bot']
+
+    if 'loop_lag_task' in app:
+        app['loop_lag_task'].cancel()
     
-    print("Приложение завершает работу. Удаляю вебхук...")
-    try:
-        # Удаляем вебхук.
-        await bot.delete_webhook()
-        print("✅ Вебхук успешно удален.")
-    except Exception as e:
-        print(f"❌ Ошибка удаления вебхука: {e}")
+    if WEB_CONCURRENCY > 1 or STATE_BACKEND != 'memory':
+        # Остальные воркеры и экземпляры с общим бэкендом продолжают принимать апдейты — вебхук не трогаем
+        print("Воркер завершает работу.")
+    else:
+        print("Приложение завершает работу. Удаляю вебхук...")
+        try:
+            # Удаляем вебхук.
+            await bot.delete_webhook()
+            print("✅ Вебхук успешно удален.")
+        except Exception as e:
+            print(f"❌ Ошибка удаления вебхука: {e}")
+
+    await send_queue.stop()
+    await subscription_store.close()
+    await history_store.close()
+    await state_backend.close()
+    print(f"📦 Кэш свечей: {ohlcv_cache.stats}")
+
+    # Не ждем зависшие загрузки: незапущенные задачи отменяем
+    analysis_executor.shutdown(wait=False, cancel_futures=True)
+    provider_chain.close()
         
 
+def build_app() -> web.Application:
+    """Собирает веб-приложение AIOHTTP с вебхуком и служебными эндпоинтами."""
+    # В aiogram 3.x используется setup_application
+    app = web.Application()
+    
+    # Сохраняем объект бота в приложении AIOHTTP для использования в startup/shutdown
+    app['bot'] = bot 
+
+    # SimpleRequestHandler связывает Dispatcher с веб-приложением AIOHTTP
+    webhook_requests_handler = SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        # Обязательно для aiogram v3! Указываем токен
+        secret_token=TELEGRAM_TOKEN,
+        handle_in_background=WEBHOOK_BACKGROUND
+    )
+    
+    # Регистрируем обработчик вебхука на определенном пути
+    webhook_requests_handler.register(app, path=WEBHOOK_PATH)
+
+    # Служебные эндпоинты: метрики и профилирование без перезапуска
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/debug/profile', profile_handler)
+
+    # Регистрируем функции запуска и отключения
+    # Теперь функции on_startup/on_shutdown получают объект app, в котором лежит bot
+    app.on_startup.append(on_startup) 
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+async def serve():
+    """Поднимает AIOHTTP-сервер и работает до SIGTERM/SIGINT.
+
+    В отличие от web.run_app, здесь видно момент bind: вебхук и тяжелая инициализация идут уже после него.
+    """
+    app = build_app()
+    runner = web.AppRunner(app)
+    await runner.setup()  # on_startup
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT, reuse_port=WEB_CONCURRENCY > 1)
+    await site.start()
+    mark_startup('bind')
+    print(f"✅ Порт {WEBAPP_PORT} открыт через {time.perf_counter() - STARTED_AT:.2f} с после старта процесса")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (os_signal.SIGTERM, os_signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    background = asyncio.create_task(after_bind(app))
+    try:
+        await stop.wait()
+    finally:
+        background.cancel()
+        await runner.cleanup()  # on_shutdown
+
+def run_worker():
+    """Один процесс веб-сервера. При нескольких воркерах порт общий (SO_REUSEPORT)."""
+    print(f"🚀 Запускаю веб-сервер на {WEBAPP_HOST}:{WEBAPP_PORT} (pid {os.getpid()})")
+    asyncio.run(serve())
+
+def run_workers(count: int):
+    """Запускает count процессов-воркеров и останавливает их все по SIGTERM/SIGINT."""
+    # Без общего состояния результат, нажатый на одном воркере, не найдет сигнал другого, а алерты
+    # потеряются — и все это без единой ошибки. Поэтому такой режим не запускаем.
+    if STATE_BACKEND == 'memory' or HISTORY_BACKEND != 'shared':
+        print("❌ Несколько воркеров требуют общего состояния: задайте STATE_BACKEND=redis и HISTORY_BACKEND=shared.")
+        return
+
+    workers = [multiprocessing.Process(target=run_worker, name=f'worker-{i}') for i in range(count)]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        for worker in workers:
+            worker.terminate()
+
+    os_signal.signal(os_signal.SIGTERM, stop)
+    os_signal.signal(os_signal.SIGINT, stop)
+    for worker in workers:
+        worker.join()
+
+mark_startup('init')
+
 if __name__ == '__main__':
     
     if not TELEGRAM_TOKEN or not WEBHOOK_HOST:
          print("Не могу запустить: Проверьте переменные TELEGRAM_TOKEN и WEBHOOK_URL.")
+    elif WEB_CONCURRENCY > 1:
+        run_workers(WEB_CONCURRENCY)
     else:
-        # В aiogram 3.x используется setup_application
-        app = web.Application()
-        
-        # Сохраняем объект бота в приложении AIOHTTP для использования в startup/shutdown
-        app['bot'] = bot 
-
-        # SimpleRequestHandler связывает Dispatcher с веб-приложением AIOHTTP
-        webhook_requests_handler = SimpleRequestHandler(
-            dispatcher=dp,
-            bot=bot,
-            # Обязательно для aiogram v3! Указываем токен
-            secret_token=TELEGRAM_TOKEN 
-        )
-        
-        # Регистрируем обработчик вебхука на определенном пути
-        webhook_requests_handler.register(app, path=WEBHOOK_PATH)
-
-        # Регистрируем функции запуска и отключения
-        # Теперь функции on_startup/on_shutdown получают объект app, в котором лежит bot
-        app.on_startup.append(on_startup) 
-        app.on_shutdown.append(on_shutdown)
-        
-        print(f"🚀 Запускаю веб-сервер на {WEBAPP_HOST}:{WEBAPP_PORT}")
-        
-        # Запускаем AIOHTTP веб-сервер
-        web.run_app(
-            app,
-            host=WEBAPP_HOST,
-            port=WEBAPP_PORT
-        )
+        run_worker()
@@ -0,0 +1,61 @@
+"""BarStore: дозапись, чтение и восстановление после оборванной записи."""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+def closed_bars(n: int, unit: str = 'ns', start: str = '2024-01-01') -> pd.DataFrame:
+    index = pd.date_range(start, periods=n, freq='15min', tz='UTC', unit=unit)
+    close = 1.1 + np.arange(n) / 1000
+    return pd.DataFrame({
+        'open': close, 'high': close + 0.001, 'low': close - 0.001, 'close': close, 'volume': np.arange(n, dtype=float),
+    }, index=index)
+
+@pytest.mark.parametrize('unit', ['s', 'us', 'ns'])
+def test_roundtrip_any_index_unit(tmp_path, unit):
+    """pandas 3 отдает индексы в s (Yfinance) и us (CSV): в хранилище время всегда в нс."""
+    store = main.BarStore(str(tmp_path))
+    df = closed_bars(50, unit)
+
+    assert store.append('EURUSD=X', '15m', df) == 50
+    assert store.last_ts('EURUSD=X', '15m') == df.index[-1]
+    assert store.append('EURUSD=X', '15m', df) == 0  # Повторная загрузка ничего не дописывает
+
+    stored = store.read('EURUSD=X', '15m')
+    assert list(stored.index) == list(df.index)
+    np.testing.assert_array_equal(stored['close'].to_numpy(), df['close'].to_numpy())
+
+    since = df.index[40]
+    assert len(store.read('EURUSD=X', '15m', since=since)) == 10
+
+@pytest.mark.parametrize('unit', ['s', 'us', 'ns'])
+def test_merge_keeps_history_and_forming_bar(tmp_path, unit):
+    store = main.BarStore(str(tmp_path))
+    now = pd.Timestamp.now(tz='UTC').floor('15min')
+    df = closed_bars(900, unit, start=now - pd.Timedelta(minutes=15 * 899))  # Последний бар — формирующийся
+
+    merged = store.merge('EURUSD=X', '15m', df, days=60)
+    assert len(merged) == 900 and merged.index[-1] == df.index[-1]
+    assert len(store.read('EURUSD=X', '15m')) == 899
+
+    merged = store.merge('EURUSD=X', '15m', df.iloc[-10:], days=60)
+    assert len(merged) == 900
+    assert len(store.read('EURUSD=X', '15m')) == 899
+
+def test_torn_write_is_truncated_before_append(tmp_path):
+    """Значение без ts (оборванная запись) не сдвигает последующие строки."""
+    store = main.BarStore(str(tmp_path))
+    df = closed_bars(15)
+    store.append('EURUSD=X', '15m', df.iloc[:10])
+    with open(os.path.join(str(tmp_path), 'EURUSD=X_15m', 'close'), 'ab') as f:
+        f.write(np.array([99.0], dtype='<f8').tobytes())
+
+    assert len(store.read('EURUSD=X', '15m')) == 10
+    assert store.append('EURUSD=X', '15m', df.iloc[10:]) == 5
+
+    stored = store.read('EURUSD=X', '15m')
+    assert list(stored.index) == list(df.index)
+    np.testing.assert_array_equal(stored['close'].to_numpy(), df['close'].to_numpy())
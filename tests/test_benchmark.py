@@ -0,0 +1,21 @@
+"""benchmark.py: замер всех этапов конвейера на синтетической фикстуре."""
+import numpy as np
+import pandas as pd
+
+import benchmark
+import main
+
+def test_bench_pair_measures_every_chain_step(tmp_path):
+    main.preimport_analytics()
+    rng = np.random.default_rng(3)
+    close = 1.1 * np.exp(np.cumsum(rng.normal(0, 0.002, 200)))
+    pd.DataFrame({
+        'Open': close, 'High': close * 1.001, 'Low': close * 0.999, 'Close': close, 'Volume': rng.integers(100, 1000, 200),
+    }, index=pd.date_range('2024-01-01', periods=200, freq='1h', tz='UTC', name='Datetime')).to_csv(tmp_path / 'EURUSD=X.csv')
+
+    result = benchmark.bench_pair(str(tmp_path / 'EURUSD=X.csv'), 'EUR/USD', repeats=1)
+
+    assert result['bars'] == 200
+    for name, _ in main.INDICATOR_CHAIN:
+        assert f'indicators.{name}' in result['stages']
+    assert {'load', 'score', 'format', 'incremental.warm', 'incremental.next_bar'} <= result['stages'].keys()
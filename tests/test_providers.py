@@ -0,0 +1,128 @@
+"""ProviderChain: предохранитель, хеджирование и failover на поставщиках-заглушках."""
+import time
+import threading
+
+import pytest
+
+import main
+
+class StubProvider(main.MarketDataProvider):
+    """Отвечает {тикер: name} через delay сек или падает, пока fail=True."""
+
+    def __init__(self, name: str, delay: float = 0, fail: bool = False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, tickers, timeframe, start, days):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise main.DataProviderError(f"{self.name}: сбой")
+        return {ticker: self.name for ticker in tickers}
+
+@pytest.fixture
+def make_chain(monkeypatch):
+    monkeypatch.setattr(main, 'PROVIDER_FAILURE_THRESHOLD', 2)
+    monkeypatch.setattr(main, 'PROVIDER_RESET_TIMEOUT', 60)
+    chains = []
+
+    def make(providers, hedge_after=5):
+        chain = main.ProviderChain(providers, hedge_after)
+        chains.append(chain)
+        return chain
+
+    yield make
+    for chain in chains:
+        chain.close()
+
+def fetch(chain):
+    return chain.fetch(['EURUSD=X'], '15m', None, 1)
+
+def expire(health):
+    """Как будто reset_timeout уже прошел."""
+    health.opened_at -= health.reset_timeout
+
+def test_failover_to_next_provider(make_chain):
+    primary, backup = StubProvider('primary', fail=True), StubProvider('backup')
+    chain = make_chain([primary, backup])
+
+    assert fetch(chain) == {'EURUSD=X': 'backup'}
+    assert chain.health['primary'].stats['failures'] == 1
+
+def test_all_failed_raises_with_every_error(make_chain):
+    chain = make_chain([StubProvider('primary', fail=True), StubProvider('backup', fail=True)])
+
+    with pytest.raises(main.DataProviderError, match='primary.*backup'):
+        fetch(chain)
+
+def test_hedge_returns_first_answer(make_chain):
+    slow, fast = StubProvider('slow', delay=1), StubProvider('fast')
+    chain = make_chain([slow, fast], hedge_after=0.05)
+
+    started = time.monotonic()
+    assert fetch(chain) == {'EURUSD=X': 'fast'}
+    assert time.monotonic() - started < 0.5
+    assert slow.calls == fast.calls == 1
+
+def test_open_breaker_skips_provider(make_chain):
+    primary, backup = StubProvider('primary', fail=True), StubProvider('backup')
+    chain = make_chain([primary, backup])
+    fetch(chain)
+    fetch(chain)
+    assert chain.health['primary'].state == 'open'
+
+    fetch(chain)
+    assert primary.calls == 2
+    assert chain.health['primary'].stats['skipped'] == 1
+
+def test_half_open_probe_closes_breaker(make_chain):
+    primary, backup = StubProvider('primary', fail=True), StubProvider('backup')
+    chain = make_chain([primary, backup])
+    fetch(chain)
+    fetch(chain)
+    primary.fail = False
+    expire(chain.health['primary'])
+
+    assert fetch(chain) == {'EURUSD=X': 'primary'}
+    assert chain.health['primary'].state == 'closed'
+    assert backup.calls == 2
+
+def test_half_open_probe_failure_reopens_breaker(make_chain):
+    primary, backup = StubProvider('primary', fail=True), StubProvider('backup')
+    chain = make_chain([primary, backup])
+    fetch(chain)
+    fetch(chain)
+    expire(chain.health['primary'])
+
+    assert fetch(chain) == {'EURUSD=X': 'backup'}
+    assert chain.health['primary'].state == 'open'
+    assert primary.calls == 3
+
+def test_breaker_of_unused_provider_stays_open(make_chain):
+    """Запасной поставщик, до которого не дошла очередь, не должен залипать в half_open."""
+    primary, backup = StubProvider('primary'), StubProvider('backup', fail=True)
+    chain = make_chain([backup, primary])
+    fetch(chain)
+    fetch(chain)
+    chain.providers.reverse()  # Теперь backup — запасной
+    expire(chain.health['backup'])
+
+    assert fetch(chain) == {'EURUSD=X': 'primary'}
+    assert chain.health['backup'].state == 'open'
+    backup.fail = False
+    chain.providers.reverse()
+    assert fetch(chain) == {'EURUSD=X': 'backup'}
+    assert chain.health['backup'].state == 'closed'
+
+def test_all_breakers_open(make_chain):
+    chain = make_chain([StubProvider('primary', fail=True)])
+    for _ in range(2):
+        with pytest.raises(main.DataProviderError, match='сбой'):
+            fetch(chain)
+
+    with pytest.raises(main.DataProviderError, match='предохранителем'):
+        fetch(chain)
@@ -0,0 +1,74 @@
+"""SendQueue: порядок рассылки внутри чата и повтор после 429."""
+import asyncio
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import main
+
+class StubBot:
+    """Записывает отправленные сообщения; на тексты из flood один раз отвечает 429."""
+
+    def __init__(self, flood=()):
+        self.sent = []
+        self.flood = set(flood)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if text in self.flood:
+            self.flood.discard(text)
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), 'Too Many Requests', retry_after=0.05)
+        self.sent.append((chat_id, text))
+        return text
+
+def deliver(monkeypatch, stub: StubBot, send, expected: int, chat_interval: float = 0.01):
+    """Прогоняет send(queue) через очередь с заглушкой бота, пока не уйдет expected сообщений."""
+    monkeypatch.setattr(main, 'bot', stub)
+
+    async def run():
+        queue = main.SendQueue(global_rate=1000, chat_interval=chat_interval, max_retries=3)
+        queue.start()
+        await send(queue)
+        for _ in range(200):
+            if len(stub.sent) >= expected:
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(run())
+    return stub.sent
+
+def by_chat(sent, chat_id):
+    return [text for chat, text in sent if chat == chat_id]
+
+def test_bulk_keeps_order_per_chat(monkeypatch):
+    async def send(queue):
+        for i in range(5):
+            queue.send(1, f'a{i}')
+            queue.send(2, f'b{i}')
+
+    sent = deliver(monkeypatch, StubBot(), send, expected=10)
+
+    assert by_chat(sent, 1) == [f'a{i}' for i in range(5)]
+    assert by_chat(sent, 2) == [f'b{i}' for i in range(5)]
+
+def test_retry_after_429_goes_before_later_messages(monkeypatch):
+    async def send(queue):
+        for text in ('first', 'second', 'third'):
+            queue.send(1, text)
+
+    sent = deliver(monkeypatch, StubBot(flood={'first'}), send, expected=3)
+
+    assert by_chat(sent, 1) == ['first', 'second', 'third']
+
+def test_interactive_call_is_not_held_by_cooling_chat(monkeypatch):
+    results = []
+
+    async def send(queue):
+        queue.send(1, 'alert1')
+        queue.send(1, 'alert2')
+        results.append(await asyncio.wait_for(queue.call('send_message', 1, text='reply'), timeout=0.5))
+
+    sent = deliver(monkeypatch, StubBot(), send, expected=3, chat_interval=1)
+
+    assert results == ['reply']
+    assert by_chat(sent, 1).index('reply') < by_chat(sent, 1).index('alert2')
@@ -0,0 +1,109 @@
+"""Общее состояние воркеров на MemoryStateBackend: история, подписки и кадры свечей."""
+import time
+import asyncio
+from datetime import datetime
+
+import pytest
+import pandas as pd
+
+import main
+
+def run(coro):
+    return asyncio.run(coro)
+
+def signal_entry(user_id=1, symbol='EUR/USD'):
+    return {
+        'user_id': user_id,
+        'symbol': symbol,
+        'direction': "ВВЕРХ \\(BUY\\) 📈",
+        'confidence': "71\\.00\\%",
+        'timestamp': datetime.now(main.TZ),
+        'result': 'Pending',
+    }
+
+def test_memory_backend_ttl_and_lock():
+    backend = main.MemoryStateBackend()
+
+    async def scenario():
+        await backend.set('k', b'v', ttl=0.05)
+        assert await backend.get('k') == b'v'
+        assert not await backend.set_nx('k', b'other')
+        time.sleep(0.06)
+        assert await backend.get('k') is None
+        assert await backend.set_nx('k', b'other')
+        assert await backend.get('k') == b'other'
+
+    run(scenario())
+
+def test_memory_backend_sets_and_lists():
+    backend = main.MemoryStateBackend()
+
+    async def scenario():
+        await backend.sadd('s', 'a')
+        await backend.sadd('s', 'b')
+        await backend.srem('s', 'a')
+        assert await backend.smembers('s') == {'b'}
+        for value in 'abcd':
+            await backend.lpush_trim('l', value, maxlen=3)
+        assert await backend.lrange('l', 0, -1) == ['d', 'c', 'b']
+        assert await backend.lrange('l', 0, 1) == ['d', 'c']
+
+    run(scenario())
+
+def test_result_pressed_on_another_worker():
+    """Сигнал создан на одном воркере, результат нажат на другом — оба видят одну запись."""
+    backend = main.MemoryStateBackend()
+    worker_a, worker_b = main.SharedHistoryStore(backend), main.SharedHistoryStore(backend)
+
+    async def scenario():
+        await worker_a.add('sig-1', signal_entry())
+        entry = await worker_b.get('sig-1')
+        assert entry['symbol'] == 'EUR/USD' and entry['result'] == 'Pending'
+
+        assert await worker_b.set_result('sig-1', 'WIN')
+        assert (await worker_a.get('sig-1'))['result'] == 'WIN'
+        # Повторное нажатие (на любом воркере) результат не меняет
+        assert not await worker_a.set_result('sig-1', 'LOSS')
+        assert [e['result'] for e in await worker_a.recent(1)] == ['WIN']
+
+    run(scenario())
+
+def test_concurrent_results_on_two_workers():
+    backend = main.MemoryStateBackend()
+    worker_a, worker_b = main.SharedHistoryStore(backend), main.SharedHistoryStore(backend)
+
+    async def scenario():
+        await worker_a.add('sig-2', signal_entry())
+        results = await asyncio.gather(worker_a.set_result('sig-2', 'WIN'), worker_b.set_result('sig-2', 'LOSS'))
+        assert sorted(results) == [False, True]
+
+    run(scenario())
+
+def test_subscription_seen_by_another_worker():
+    backend = main.MemoryStateBackend()
+    worker_a, worker_b = main.SharedSubscriptionStore(backend), main.SharedSubscriptionStore(backend)
+
+    async def scenario():
+        assert await worker_a.toggle(42, 'GBP/USD')
+        assert await worker_b.subscribers('GBP/USD') == {42}
+        assert not await worker_b.toggle(42, 'GBP/USD')
+        assert await worker_a.subscribers('GBP/USD') == set()
+
+    run(scenario())
+
+@pytest.mark.parametrize('unit', ['s', 'us', 'ns'])
+def test_ohlcv_frame_roundtrip(unit):
+    index = pd.date_range('2024-01-01', periods=4, freq='15min', tz='UTC', unit=unit)
+    df = pd.DataFrame({
+        'open': [1.0, 1.1, 1.2, 1.3], 'high': [1.5] * 4, 'low': [0.9] * 4,
+        'close': [1.1, 1.2, 1.3, 1.4], 'volume': [0.0, 10.0, 20.0, 30.0],
+    }, index=index)
+
+    decoded = main.decode_ohlcv(main.encode_ohlcv(df))
+    pd.testing.assert_frame_equal(decoded, df.set_axis(index.as_unit('ns')), check_freq=False)
+
+def test_workers_refuse_to_start_without_shared_state(monkeypatch):
+    monkeypatch.setattr(main, 'STATE_BACKEND', 'memory')
+    monkeypatch.setattr(main, 'HISTORY_BACKEND', 'sqlite')
+    monkeypatch.setattr(main.multiprocessing, 'Process', lambda *a, **kw: pytest.fail("воркер запущен"))
+    main.run_workers(2)
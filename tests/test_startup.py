@@ -0,0 +1,27 @@
+"""Фоновый старт после bind: сбой одного шага не отменяет остальные."""
+import asyncio
+
+import main
+
+def test_scheduler_starts_when_preimport_fails(monkeypatch, capsys):
+    started = []
+
+    async def set_webhook(bot):
+        pass
+
+    async def prewarm_scheduler():
+        started.append(True)
+
+    def preimport_analytics():
+        raise ImportError("pandas_ta")
+
+    monkeypatch.setattr(main, 'set_webhook', set_webhook)
+    monkeypatch.setattr(main, 'prewarm_scheduler', prewarm_scheduler)
+    monkeypatch.setattr(main, 'preimport_analytics', preimport_analytics)
+    monkeypatch.setattr(main, 'ANALYTICS_PREIMPORT', True)
+    monkeypatch.setattr(main, 'PREWARM_ENABLED', True)
+
+    asyncio.run(main.after_bind({'bot': None}))
+
+    assert started
+    assert 'pandas_ta' in capsys.readouterr().out
@@ -0,0 +1,30 @@
+"""Сила валют: одновременные запросы устаревшего снимка делят один пересчет."""
+import asyncio
+
+import main
+
+def test_concurrent_requests_share_one_rebuild(monkeypatch):
+    rebuilds = []
+
+    async def lookup_strength(timeframe):
+        return None
+
+    async def rebuild(timeframe):
+        rebuilds.append(timeframe)
+        await asyncio.sleep(0.05)
+        return {'timeframe': timeframe}
+
+    monkeypatch.setattr(main, 'lookup_strength', lookup_strength)
+    monkeypatch.setattr(main, '_rebuild_strength', rebuild)
+
+    async def run():
+        first = await asyncio.gather(*(main.get_strength('1h') for _ in range(10)), main.get_strength('4h'))
+        second = await main.get_strength('1h')
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first[:10] == [{'timeframe': '1h'}] * 10 and first[10] == {'timeframe': '4h'}
+    assert second == {'timeframe': '1h'}
+    assert sorted(rebuilds) == ['1h', '1h', '4h']  # Второй 1h — новый пересчет после завершения первого
+    assert not main.strength_rebuilds
@@ -0,0 +1,31 @@
+"""Ответ на нажатие кнопки телом ответа вебхука (WEBHOOK_BACKGROUND=0)."""
+import asyncio
+
+from aiogram import types
+from aiogram.methods import AnswerCallbackQuery
+
+import main
+
+def press(monkeypatch, **kwargs):
+    """Хендлер вызывает answer(**kwargs) под middleware; возвращает результат для ответа вебхука."""
+    monkeypatch.setattr(main, 'WEBHOOK_BACKGROUND', False)
+    query = types.CallbackQuery(
+        id='42', chat_instance='1', from_user=types.User(id=1, is_bot=False, first_name='Test')
+    )
+
+    async def handler(event, data):
+        await main.answer(event, **kwargs)
+
+    return asyncio.run(main.webhook_answer_middleware(handler, query, {}))
+
+def test_answer_is_returned_as_webhook_reply(monkeypatch):
+    result = press(monkeypatch, text="Подписка оформлена: EUR/USD")
+
+    assert isinstance(result, AnswerCallbackQuery)
+    assert result.callback_query_id == '42' and result.text == "Подписка оформлена: EUR/USD"
+
+def test_progress_text_is_dropped_in_webhook_reply(monkeypatch):
+    """Ответ вебхука уходит после анализа — «Анализирую...» к этому моменту уже неправда."""
+    result = press(monkeypatch, text="Сравниваю валюты...", progress=True)
+
+    assert isinstance(result, AnswerCallbackQuery) and result.text is None